@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare two benchmark result files written by run.py.
+
+    python benchmarks/compare.py before.json after.json
+
+Prints, for every case and metric, the old value, the new value and the
+ratio new/old.
+"""
+import json
+import sys
+
+
+METRICS = ('load_seconds', 'parse_latency_us', 'interpret_latency_us',
+           'throughput_per_second', 'peak_memory_bytes')
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report, dict((r['case'], r) for r in report['results'])
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        sys.exit(__doc__)
+    (old_report, old), (new_report, new) = load(argv[0]), load(argv[1])
+    print('{:<12} {:<22} {:>14} {:>14} {:>8}'.format(
+        'case', 'metric', old_report['commit'], new_report['commit'], 'ratio'))
+    for case in sorted(set(old) & set(new)):
+        for metric in METRICS:
+            before, after = old[case][metric], new[case][metric]
+            ratio = after / before if before else float('nan')
+            print('{:<12} {:<22} {:>14.4g} {:>14.4g} {:>8.2f}'.format(
+                case, metric, before, after, ratio))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Run the nimrod benchmarks and write the results as JSON.
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/compare.py before.json after.json
+
+Every case writes a synthetic grammar to a temporary directory and measures
+load time, per-call latency of parse() and interpret(), batch throughput and
+peak memory.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import nimrod  # noqa: E402
+from nimrod import store  # noqa: E402
+from synthetic import write_grammar  # noqa: E402
+
+
+CASES = {
+    'small': dict(symbols=20, entries=4, depth=3),
+    'wide': dict(symbols=2000, entries=20, depth=3),
+    'deep': dict(symbols=200, entries=4, depth=20, refs_per_entry=1),
+    'branching': dict(symbols=200, entries=4, depth=6, refs_per_entry=3),
+    'gated': dict(symbols=200, entries=5, depth=5, gate_density=0.8),
+    'variables': dict(symbols=200, entries=5, depth=5, variable_density=0.8),
+    'imports': dict(symbols=2000, entries=10, depth=4, imports=50),
+}
+
+
+def best_of(repeat, function):
+    """Return the shortest of repeat timings of function()."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run_case(name, params, count, repeat):
+    directory = tempfile.mkdtemp()
+    try:
+        path = write_grammar(directory, **params)
+
+        def load():
+            # measure a cold load, not a copy shared by the previous one
+            store.clear()
+            g = nimrod.Grammar()
+            g.load(path)
+            return g
+
+        load_seconds = best_of(repeat, load)
+        g = load()
+
+        parse = min(timeit.repeat(lambda: g.parse('{default}'),
+                                  number=count, repeat=repeat)) / count
+        interpret = min(timeit.repeat(lambda: g.interpret('default'),
+                                      number=count, repeat=repeat)) / count
+
+        if hasattr(g, 'generate_many'):
+            batch = best_of(repeat, lambda: g.generate_many('default', count))
+        else:
+            batch = parse * count
+
+        tracemalloc.start()
+        g = load()
+        for _ in range(count):
+            g.parse('{default}')
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(directory)
+
+    return {
+        'case': name,
+        'params': params,
+        'load_seconds': load_seconds,
+        'parse_latency_us': parse * 1e6,
+        'interpret_latency_us': interpret * 1e6,
+        'throughput_per_second': count / batch,
+        'peak_memory_bytes': peak,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('cases', nargs='*',
+                        help='cases to run, from {} (default: all)'.format(
+                            ', '.join(sorted(CASES))))
+    parser.add_argument('--count', type=int, default=1000,
+                        help='generations per measurement')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='repetitions; the best one is reported')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args(argv)
+    unknown = set(args.cases) - set(CASES)
+    if unknown:
+        parser.error('unknown cases: ' + ', '.join(sorted(unknown)))
+
+    results = []
+    for name in args.cases or sorted(CASES):
+        result = run_case(name, CASES[name], args.count, args.repeat)
+        sys.stderr.write(
+            '{case}: load {load_seconds:.4f}s, parse {parse_latency_us:.1f}'
+            'us, {throughput_per_second:.0f}/s, peak {peak_memory_bytes} '
+            'bytes\n'.format(**result))
+        results.append(result)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'timestamp': time.time(),
+        'count': args.count,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
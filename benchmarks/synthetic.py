@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Synthetic grammars of controlled size, depth and branching.
+
+The generated grammar is layered: #default refers to symbols in level 0, and
+every symbol in level L refers only to symbols in level L+1, so the nesting
+depth is exact and the grammar always terminates. The deepest level holds
+plain words.
+"""
+import os
+import random
+
+
+WORDS = ('apple', 'brick', 'cloud', 'dune', 'ember', 'fjord', 'grove',
+         'harbor', 'island', 'jungle', 'kettle', 'lantern', 'meadow', 'nectar')
+
+
+def symbol_name(level, index):
+    return 's{}_{}'.format(level, index)
+
+
+def make_entry(rng, level, per_level, depth, gate_density, variable_density,
+               refs_per_entry):
+    parts = [rng.choice(WORDS)]
+    if level + 1 < depth:
+        for _ in range(refs_per_entry):
+            ref = '{' + symbol_name(level + 1, rng.randrange(per_level)) + '}'
+            if rng.random() < gate_density:
+                if rng.random() < 0.5:
+                    ref = '<0.5|{}>'.format(ref)
+                else:
+                    other = symbol_name(level + 1, rng.randrange(per_level))
+                    ref = '<0.5|{}|{{{}}}>'.format(ref, other)
+            parts.append(ref)
+    if rng.random() < variable_density:
+        if rng.random() < 0.5:
+            parts.insert(0, '$v{}="{}"'.format(rng.randrange(8),
+                                               rng.choice(WORDS)))
+        else:
+            parts.append('$v{}'.format(rng.randrange(8)))
+    return ' '.join(parts)
+
+
+def write_grammar(directory, symbols=100, entries=5, depth=4, refs_per_entry=2,
+                  gate_density=0.2, variable_density=0.1, imports=0, seed=0):
+    """Write a synthetic grammar into directory and return the path of its
+    root file, without the .txt extension.
+
+    symbols: total number of symbols, spread evenly over the levels
+    entries: definition lines per symbol
+    depth: number of levels below #default
+    refs_per_entry: symbol references in each non-leaf entry
+    gate_density: fraction of references wrapped in <p|...> or <p|A|B>
+    variable_density: fraction of entries assigning or referencing a variable
+    imports: number of files the symbols are split across, imported by the
+      root file; 0 puts everything in the root file
+    """
+    rng = random.Random(seed)
+    per_level = max(1, symbols // depth)
+    files = [[] for _ in range(max(1, imports))]
+
+    for level in range(depth):
+        for index in range(per_level):
+            lines = ['#' + symbol_name(level, index)]
+            for _ in range(entries):
+                lines.append(make_entry(rng, level, per_level, depth,
+                                        gate_density, variable_density,
+                                        refs_per_entry))
+            files[rng.randrange(len(files))].append('\n'.join(lines))
+
+    root = ['#default']
+    for index in range(min(per_level, entries)):
+        root.append('{' + symbol_name(0, index) + '}')
+
+    if imports:
+        header = ['#import part{}'.format(i) for i in range(imports)]
+        for i, blocks in enumerate(files):
+            path = os.path.join(directory, 'part{}.txt'.format(i))
+            with open(path, 'w') as f:
+                f.write('\n\n'.join(blocks) + '\n')
+        blocks = ['\n'.join(header), '\n'.join(root)]
+    else:
+        blocks = ['\n'.join(root)] + files[0]
+
+    path = os.path.join(directory, 'root')
+    with open(path + '.txt', 'w') as f:
+        f.write('\n\n'.join(blocks) + '\n')
+    return path
@@ -6,3 +6,6 @@ __email__ = 'scrudgey@gmail.com'
 __version__ = '0.1.0'
 
 from .nimrod import Grammar
+from .dedup import Deduplicator
+from .budget import Budget, BudgetExceeded
+from .library import GrammarLibrary
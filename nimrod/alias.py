@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""Walker's alias method for weighted choices in constant time."""
+
+
+class AliasTable(object):
+    """Weighted choice among len(weights) indices with a single uniform draw.
+
+    Built with Vose's algorithm in O(n); every pick is O(1) no matter how
+    many entries there are.
+    """
+    __slots__ = ('n', 'prob', 'alias')
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        if not n or total <= 0:
+            raise ValueError('weights must have a positive sum')
+        scaled = [w * n / total for w in weights]
+        prob = [1.0] * n
+        alias = list(range(n))
+        small = [i for i, w in enumerate(scaled) if w < 1.0]
+        large = [i for i, w in enumerate(scaled) if w >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # whatever is left over is 1 up to rounding error
+        self.n = n
+        self.prob = prob
+        self.alias = alias
+
+    def pick(self, u):
+        """Return an index for a uniform float 0 <= u < 1."""
+        u *= self.n
+        i = int(u)
+        if u - i < self.prob[i]:
+            return i
+        return self.alias[i]
+
+    def probabilities(self):
+        """Return the probability of picking each index."""
+        p = [0.0] * self.n
+        for i in range(self.n):
+            p[i] += self.prob[i] / self.n
+            p[self.alias[i]] += (1.0 - self.prob[i]) / self.n
+        return p
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Static analysis of the symbol reference graph of a compiled grammar."""
+from .compiler import (EitherOr, LazyAssign, ProbGate, SymbolRef, VarAssign,
+                       compile_template)
+from .store import TextTable
+
+INFINITY = float('inf')
+
+
+class Analysis(object):
+    """The result of analyzing a grammar.
+
+    unresolved: dict of symbol -> sorted list of undefined symbols it refers to
+    unreachable: set of symbols that cannot be reached from the roots
+    cycles: list of sorted lists of symbols that can expand into each other
+    nonterminating: set of symbols that have no finite expansion
+    min_depth: dict of symbol -> fewest nested symbol levels of an expansion,
+      or None if nonterminating
+    max_depth: dict of symbol -> most nested symbol levels of an expansion,
+      or None if unbounded
+    """
+
+    def __init__(self, unresolved, unreachable, cycles, nonterminating,
+                 min_depth, max_depth):
+        self.unresolved = unresolved
+        self.unreachable = unreachable
+        self.cycles = cycles
+        self.nonterminating = nonterminating
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+
+    def __repr__(self):
+        return ('<Analysis: {} unresolved, {} unreachable, {} cycles, '
+                '{} nonterminating>'.format(
+                    len(self.unresolved), len(self.unreachable),
+                    len(self.cycles), len(self.nonterminating)))
+
+
+def references(nodes, refs=None):
+    """Return the set of symbols nodes may refer to, including symbols in
+    the values of variable assignments. Branches that can never be taken
+    are skipped.
+    """
+    if refs is None:
+        refs = set()
+    if nodes.__class__ is str:
+        return refs
+    for node in nodes:
+        cls = node.__class__
+        if cls is SymbolRef:
+            refs.add(node.name)
+        elif cls is ProbGate:
+            if node.p > 0:
+                references(node.body, refs)
+        elif cls is EitherOr:
+            if node.p > 0:
+                references(node.first, refs)
+            if node.p < 1:
+                references(node.second, refs)
+        elif cls is VarAssign or cls is LazyAssign:
+            references(compile_template(node.value), refs)
+    return refs
+
+
+def reference_graph(compiled):
+    """Return a dict of symbol -> set of symbols its entries may refer to."""
+    graph = {}
+    for symbol, entries in compiled.items():
+        refs = set()
+        if not isinstance(entries, TextTable):
+            for entry in set(entries):
+                references(entry, refs)
+        graph[symbol] = refs
+    return graph
+
+
+def _min_cost(nodes, compiled, depth):
+    # the fewest symbol levels these nodes must expand through
+    cost = 0
+    if nodes.__class__ is str:
+        return cost
+    for node in nodes:
+        cls = node.__class__
+        if cls is SymbolRef:
+            if node.name in compiled:
+                cost = max(cost, depth[node.name])
+        elif cls is ProbGate:
+            if node.p >= 1:
+                cost = max(cost, _min_cost(node.body, compiled, depth))
+        elif cls is EitherOr:
+            branches = []
+            if node.p > 0:
+                branches.append(_min_cost(node.first, compiled, depth))
+            if node.p < 1:
+                branches.append(_min_cost(node.second, compiled, depth))
+            cost = max(cost, min(branches))
+    return cost
+
+
+def min_depths(compiled):
+    """Return a dict of symbol -> fewest nested symbol levels any expansion
+    of it needs, infinite if every expansion recurses forever.
+    """
+    depth = dict((symbol, INFINITY) for symbol in compiled)
+    changed = True
+    while changed:
+        changed = False
+        for symbol, entries in compiled.items():
+            if isinstance(entries, TextTable):
+                best = 1
+            else:
+                best = min([_min_cost(entry, compiled, depth)
+                            for entry in entries] or [0]) + 1
+            if best < depth[symbol]:
+                depth[symbol] = best
+                changed = True
+    return depth
+
+
+def strongly_connected(graph):
+    """Return the strongly connected components of graph, each one after
+    every component it can reach.
+    """
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    components = []
+    counter = 0
+    for start in graph:
+        if start in index:
+            continue
+        work = [(start, iter(graph[start]))]
+        index[start] = low[start] = counter
+        counter += 1
+        stack.append(start)
+        on_stack.add(start)
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in graph:
+                    continue
+                if child not in index:
+                    index[child] = low[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(graph[child])))
+                    break
+                if child in on_stack:
+                    low[node] = min(low[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+def reachable(graph, roots):
+    """Return the set of symbols reachable from roots in graph."""
+    seen = set(root for root in roots if root in graph)
+    pending = list(seen)
+    while pending:
+        for child in graph[pending.pop()]:
+            if child in graph and child not in seen:
+                seen.add(child)
+                pending.append(child)
+    return seen
+
+
+def analyze(compiled, roots=('default',)):
+    """Analyze a dict of symbol -> list of compiled entries."""
+    graph = reference_graph(compiled)
+
+    unresolved = {}
+    for symbol, refs in graph.items():
+        missing = sorted(ref for ref in refs if ref not in graph)
+        if missing:
+            unresolved[symbol] = missing
+
+    roots = [root for root in roots if root in graph]
+    if roots:
+        unreachable = set(graph) - reachable(graph, roots)
+    else:
+        unreachable = set()
+
+    cycles = []
+    max_depth = {}
+    for component in strongly_connected(graph):
+        if len(component) > 1 or component[0] in graph[component[0]]:
+            cycles.append(sorted(component))
+            for symbol in component:
+                max_depth[symbol] = None
+            continue
+        symbol = component[0]
+        deepest = 0
+        for ref in graph[symbol]:
+            if ref in graph:
+                if max_depth[ref] is None:
+                    deepest = None
+                    break
+                deepest = max(deepest, max_depth[ref])
+        max_depth[symbol] = None if deepest is None else deepest + 1
+
+    depths = min_depths(compiled)
+    nonterminating = set(s for s, d in depths.items() if d == INFINITY)
+    min_depth = dict((s, None if d == INFINITY else d)
+                     for s, d in depths.items())
+
+    return Analysis(unresolved, unreachable, sorted(cycles), nonterminating,
+                    min_depth, max_depth)
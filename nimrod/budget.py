@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Limits on the work a single expansion may do.
+
+The depth limit of a grammar stops runaway recursion, but not a grammar that
+branches widely: a few levels of symbols with several references each can
+produce more text than fits in memory. A Budget bounds one expansion, one
+string returned by parse(), interpret() or generate(), by the text it
+produces, the references it expands, how deep they nest and how long it
+takes. Expansions walked without a budget pay nothing for it.
+"""
+
+TRUNCATE = 'truncate'
+RAISE = 'raise'
+FALLBACK = 'fallback'
+POLICIES = (TRUNCATE, RAISE, FALLBACK)
+
+
+class BudgetExceeded(Exception):
+    """An expansion ran out of budget under the 'raise' policy.
+
+    limit is the name of the exhausted limit: 'chars', 'expansions', 'depth'
+    or 'deadline'. partial is the text expanded until then.
+    """
+
+    def __init__(self, limit, partial=''):
+        super(BudgetExceeded, self).__init__(
+            'expansion exceeded its {} budget'.format(limit))
+        self.limit = limit
+        self.partial = partial
+
+
+class Budget(object):
+    """Limits on one expansion. A limit of None does not apply.
+
+    OPTIONAL ARGUMENTS:
+    max_chars: int
+      most characters of text to produce
+    max_expansions: int
+      most {symbol} and $variable references to expand
+    max_depth: int
+      deepest nesting of symbols to expand, counted like Grammar.max_depth
+    deadline: float
+      most seconds to spend
+    policy: str (default 'truncate')
+      what a used up budget gives:
+      'truncate': the text expanded so far, cut to max_chars
+      'raise': a BudgetExceeded error
+      'fallback': the text fallback instead of anything expanded
+    fallback: str (default '')
+      text returned under the 'fallback' policy
+    """
+    __slots__ = ('max_chars', 'max_expansions', 'max_depth', 'deadline',
+                 'policy', 'fallback')
+
+    def __init__(self, max_chars=None, max_expansions=None, max_depth=None,
+                 deadline=None, policy=TRUNCATE, fallback=''):
+        if policy not in POLICIES:
+            raise ValueError('policy must be one of {}'.format(
+                ', '.join(POLICIES)))
+        self.max_chars = max_chars
+        self.max_expansions = max_expansions
+        self.max_depth = max_depth
+        self.deadline = deadline
+        self.policy = policy
+        self.fallback = fallback
+
+    def __reduce__(self):
+        return Budget, (self.max_chars, self.max_expansions, self.max_depth,
+                        self.deadline, self.policy, self.fallback)
+
+    def __repr__(self):
+        limits = ', '.join('{}={!r}'.format(name, getattr(self, name))
+                           for name in self.__slots__
+                           if getattr(self, name) is not None)
+        return 'Budget({})'.format(limits)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""On-disk cache of compiled grammars.
+
+A cache file holds the compiled definitions of a root grammar file and of
+every file it imports, together with the size and modification time of each
+file. It is only used if none of those files has changed since. An index
+file holds, in the same way, the symbols each file defines and the files it
+imports, for grammars that are loaded lazily.
+
+Cache files are pickles: only read caches from directories you trust as much
+as your code.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# bump whenever the layout of compiled definitions changes
+CACHE_VERSION = 3
+CACHE_SUFFIX = '.nimrodc'
+INDEX_SUFFIX = '.nimrodi'
+
+
+def cache_path(path, cache_dir=None, suffix=CACHE_SUFFIX):
+    """Return the cache file for the grammar file at path, either next to it
+    or, if cache_dir is given, in that directory.
+    """
+    if cache_dir is None:
+        return os.path.splitext(path)[0] + suffix
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, digest + suffix)
+
+
+def file_key(path):
+    """Return the (size, mtime) a cached file is checked against."""
+    statbuf = os.stat(path)
+    return statbuf.st_size, statbuf.st_mtime
+
+
+def _read_entries(cache_file):
+    # the stored list of (path, size, mtime, ...), or None if any of the
+    # files changed
+    try:
+        with open(cache_file, 'rb') as f:
+            data = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if not isinstance(data, dict) or data.get('version') != CACHE_VERSION:
+        return None
+    for entry in data['sources']:
+        try:
+            if file_key(entry[0]) != entry[1:3]:
+                return None
+        except OSError:
+            return None
+    return data['sources']
+
+
+def read_cache(cache_file):
+    """Return the list of (path, (size, mtime), source, imports) stored in
+    cache_file, or None if there is no usable cache or any of its files has
+    changed.
+    """
+    entries = _read_entries(cache_file)
+    if entries is None:
+        return None
+    return [(path, (size, mtime), source, imports)
+            for path, size, mtime, source, imports in entries]
+
+
+def read_index(index_file):
+    """Return the list of (path, keys, imports) stored in index_file, or
+    None if there is no usable index or any of its files has changed.
+    """
+    entries = _read_entries(index_file)
+    if entries is None:
+        return None
+    return [(path, keys, imports)
+            for path, size, mtime, keys, imports in entries]
+
+
+def write_cache(cache_file, sources):
+    """Store a list of (path, mtime, source, imports) in cache_file.
+
+    mtime is the modification time the source was read at; a file modified
+    since then makes the cache stale.
+    """
+    entries = []
+    for path, mtime, source, imports in sources:
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            return
+        entries.append((path, size, mtime, source, imports))
+    _write_entries(cache_file, entries)
+
+
+def write_index(index_file, files):
+    """Store a list of (path, keys, imports) in index_file, checked against
+    the current size and modification time of each file.
+    """
+    entries = []
+    for path, keys, imports in files:
+        try:
+            size, mtime = file_key(path)
+        except OSError:
+            return
+        entries.append((path, size, mtime, keys, imports))
+    _write_entries(index_file, entries)
+
+
+def _write_entries(cache_file, entries):
+    data = {'version': CACHE_VERSION, 'sources': entries}
+
+    directory = os.path.dirname(cache_file) or '.'
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, temp_path = tempfile.mkstemp(dir=directory,
+                                             suffix=CACHE_SUFFIX)
+        with os.fdopen(handle, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_file)
+    except OSError as error:
+        logger.warning('could not write grammar cache %s: %s',
+                       cache_file, error)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""The nimrod command line."""
+import argparse
+import json
+import logging
+import sys
+import time
+
+from . import parallel, server
+from .context import Context
+from .nimrod import Grammar
+from .reload import NoReload
+from .rng import draw_source
+
+# bytes of output collected before each write
+WRITE_BUFFER = 1 << 20
+
+
+def expansion_batches(grammar, symbol, count, seed=None, workers=None,
+                      batch_size=10000):
+    """Yield lists of expansions of symbol, count in all."""
+    if workers is not None and workers > 1:
+        for batch in parallel.iter_parallel(grammar, symbol, count, workers,
+                                            seed, batch_size):
+            yield batch
+        return
+    context = Context(grammar, draw_source(seed))
+    for start in range(0, count, batch_size):
+        yield context.generate(symbol, min(batch_size, count - start))
+
+
+def encode_lines(batch):
+    return ('\n'.join(batch) + '\n').encode('utf-8')
+
+
+def encode_ndjson(batch):
+    return ('\n'.join(json.dumps(text) for text in batch)
+            + '\n').encode('utf-8')
+
+
+class Progress(object):
+    """Report the number of expansions written and the rate to stderr."""
+
+    def __init__(self, total, stream=sys.stderr, interval=0.5):
+        self.total = total
+        self.stream = stream
+        self.interval = interval
+        self.start = self.last = time.perf_counter()
+        self.count = 0
+        self.bytes = 0
+
+    def update(self, count, size):
+        self.count += count
+        self.bytes += size
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.stream.write('\rnimrod: {}/{} ({:.0%}) {:.0f}/s'.format(
+                self.count, self.total, self.count / float(self.total),
+                self.rate(now)))
+            self.stream.flush()
+
+    def rate(self, now=None):
+        elapsed = (now or time.perf_counter()) - self.start
+        return self.count / elapsed if elapsed > 0 else 0.0
+
+    def finish(self):
+        elapsed = time.perf_counter() - self.start
+        self.stream.write('\rnimrod: {} expansions in {:.2f}s, {:.0f}/s, '
+                          '{:.1f} MB\n'.format(self.count, elapsed,
+                                               self.rate(),
+                                               self.bytes / 1e6))
+        self.stream.flush()
+
+
+def load_error(error):
+    """Return the exit of the command line for an OSError raised while
+    loading grammars.
+    """
+    if error.filename is not None and error.strerror is not None:
+        message = '{}: {}'.format(error.filename, error.strerror)
+    else:
+        message = str(error)
+    return SystemExit('nimrod: cannot load grammar: ' + message)
+
+
+def load_grammar(path):
+    grammar = Grammar(reload_policy=NoReload())
+    try:
+        grammar.load(path)
+    except OSError as error:
+        raise load_error(error)
+    return grammar
+
+
+def generate_command(args):
+    grammar = load_grammar(args.grammar)
+    encode = encode_ndjson if args.format == 'ndjson' else encode_lines
+    if args.output == '-':
+        output = sys.stdout.buffer
+    else:
+        output = open(args.output, 'wb')
+    progress = None if args.quiet else Progress(args.count)
+    try:
+        pending = []
+        size = 0
+        for batch in expansion_batches(grammar, args.symbol, args.count,
+                                       args.seed, args.workers,
+                                       args.batch_size):
+            data = encode(batch)
+            pending.append(data)
+            size += len(data)
+            if size >= WRITE_BUFFER:
+                output.write(b''.join(pending))
+                pending, size = [], 0
+            if progress is not None:
+                progress.update(len(batch), len(data))
+        output.write(b''.join(pending))
+        output.flush()
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+    if progress is not None:
+        progress.finish()
+
+
+def profile_command(args):
+    grammar = load_grammar(args.grammar)
+    grammar.enable_profiling()
+    grammar.generate_many(args.symbol, args.count, args.seed)
+    profile = grammar.profile()
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(profile.collapsed(args.weight))
+    sys.stdout.write(profile.report(args.top, args.weight))
+
+
+def serve_command(args):
+    try:
+        grammars = server.load_grammars(args.grammars)
+    except OSError as error:
+        raise load_error(error)
+    where = args.socket or '{}:{}'.format(args.host, args.port)
+    logging.getLogger(__name__).info('serving %s on %s',
+                                     ', '.join(sorted(grammars)), where)
+    server.serve(grammars, host=args.host, port=args.port, path=args.socket,
+                 workers=args.workers)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='nimrod', description='Generate text from nimrod grammars.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    generate = commands.add_parser(
+        'generate', help='write many expansions of a symbol')
+    generate.add_argument('grammar', help='grammar file to load')
+    generate.add_argument('-s', '--symbol', default='default',
+                          help='symbol to expand (default: default)')
+    generate.add_argument('-n', '--count', type=int, default=1,
+                          help='number of expansions (default: 1)')
+    generate.add_argument('-o', '--output', default='-',
+                          help='file to write to (default: stdout)')
+    generate.add_argument('-f', '--format', choices=['lines', 'ndjson'],
+                          default='lines',
+                          help='one expansion per line, as plain text or as '
+                               'a JSON string (default: lines)')
+    generate.add_argument('--seed', type=int, default=None,
+                          help='seed for reproducible output')
+    generate.add_argument('--workers', type=int, default=None,
+                          help='generate with this many processes')
+    generate.add_argument('--batch-size', type=int, default=10000,
+                          help='expansions generated per batch')
+    generate.add_argument('-q', '--quiet', action='store_true',
+                          help='do not report progress on stderr')
+    generate.set_defaults(run=generate_command)
+
+    profile = commands.add_parser(
+        'profile', help='report which symbols of a grammar cost the most')
+    profile.add_argument('grammar', help='grammar file to load')
+    profile.add_argument('-s', '--symbol', default='default',
+                         help='symbol to expand (default: default)')
+    profile.add_argument('-n', '--count', type=int, default=1000,
+                         help='number of expansions (default: 1000)')
+    profile.add_argument('-o', '--output', default=None,
+                         help='write collapsed stacks for flame graph tools '
+                              'to this file')
+    profile.add_argument('-w', '--weight', choices=['time', 'chars', 'calls'],
+                         default='time',
+                         help='what to rank and weigh stacks by '
+                              '(default: time)')
+    profile.add_argument('--top', type=int, default=20,
+                         help='number of symbols to report (default: 20)')
+    profile.add_argument('--seed', type=int, default=None,
+                         help='seed for reproducible output')
+    profile.set_defaults(run=profile_command)
+
+    serve = commands.add_parser(
+        'serve', help='serve generations over HTTP from loaded grammars')
+    serve.add_argument('grammars', nargs='+', metavar='grammar',
+                       help='grammar file to serve, named after the file')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--socket', default=None,
+                       help='listen on this Unix socket instead of TCP')
+    serve.add_argument('--workers', type=int, default=None,
+                       help='threads generating batches')
+    serve.set_defaults(run=serve_command)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='nimrod: %(message)s')
+    args.run(args)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""Compile nimrod template strings into expansion trees.
+
+A template is tokenized once into a tuple of nodes. Each node has a step()
+method that makes the node's random decisions and returns what it expands
+to: a string of output, a tuple of (nodes, depth) to walk next, or None.
+Steps read and write nothing but the nimrod.context.Context they are given,
+which walks them depth-first, either appending the strings to a list that is
+joined once at the end, or yielding them as they are produced. Compiled
+nodes are never modified, so one tree can be walked by many contexts at once.
+"""
+import re
+import sys
+
+
+# Variable assignments are pulled out of a template before anything else,
+# exactly like the first stage of the string-rewriting parser.
+var_assign_hook = re.compile(r'(\W|^)\$(\w+)="(.+)"')
+var_lazy_assign_hook = re.compile(r' \$\$(\w+)$')
+
+# Body tokens, in order of precedence at any given position:
+# <p|A|B>, <p|string>, {symbol}, $variable
+token_hook = re.compile(r'<([\.\d]*)\|([^\|>]*)\|([^\|>]*)>'
+                        r'|<([\.\d]+)\|(.+?)>'
+                        r'|\{(.+?)\}'
+                        r'|\$(\w+)')
+
+# every token and assignment starts with one of these characters
+special_hook = re.compile(r'[<{$]')
+
+
+class Literal(object):
+    """Plain text."""
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __reduce__(self):
+        return Literal, (self.text,)
+
+    def step(self, context, depth):
+        return self.text
+
+
+class SymbolRef(object):
+    """{symbol}: a random expansion of symbol."""
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __reduce__(self):
+        return SymbolRef, (self.name,)
+
+    def step(self, context, depth):
+        return context.step_symbol(self.name, depth)
+
+
+class ProbGate(object):
+    """<p|string>: string with probability p."""
+    __slots__ = ('p', 'body')
+
+    def __init__(self, p, body):
+        self.p = p
+        self.body = body
+
+    def __reduce__(self):
+        return ProbGate, (self.p, self.body)
+
+    def step(self, context, depth):
+        if context.gate(self.p):
+            return self.body, depth
+        return None
+
+
+class EitherOr(object):
+    """<p|A|B>: A with probability p, otherwise B."""
+    __slots__ = ('p', 'first', 'second')
+
+    def __init__(self, p, first, second):
+        self.p = p
+        self.first = first
+        self.second = second
+
+    def __reduce__(self):
+        return EitherOr, (self.p, self.first, self.second)
+
+    def step(self, context, depth):
+        if context.gate(self.p):
+            return self.first, depth
+        return self.second, depth
+
+
+class VarAssign(object):
+    """$variable="value": store value, emit nothing."""
+    __slots__ = ('name', 'value')
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def __reduce__(self):
+        return VarAssign, (self.name, self.value)
+
+    def step(self, context, depth):
+        context.variables[self.name] = self.value
+        return None
+
+
+class LazyAssign(object):
+    """string $$variable: store the rest of the line in variable."""
+    __slots__ = ('name', 'value')
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def __reduce__(self):
+        return LazyAssign, (self.name, self.value)
+
+    def step(self, context, depth):
+        context.variables[self.name] = self.value
+        return None
+
+
+class VarRef(object):
+    """$variable: the expansion of the stored value of variable."""
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __reduce__(self):
+        return VarRef, (self.name,)
+
+    def step(self, context, depth):
+        return context.step_variable(self.name, depth)
+
+
+def _probability(text):
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def _node(memo, cls, *args):
+    # share one node between all identical occurrences
+    if memo is None:
+        return cls(*args)
+    key = (cls,) + args
+    node = memo.get(key)
+    if node is None:
+        node = memo[key] = cls(*args)
+    return node
+
+
+def compile_body(string, memo=None):
+    """Tokenize gates, symbols and variable references into a node tuple."""
+    nodes = []
+    position = 0
+    for match in token_hook.finditer(string):
+        start, end = match.span()
+        node = None
+        if match.group(1) is not None:
+            p = _probability(match.group(1))
+            if p is not None:
+                node = _node(memo, EitherOr, p,
+                             compile_body(match.group(2), memo),
+                             compile_body(match.group(3), memo))
+        elif match.group(4) is not None:
+            p = _probability(match.group(4))
+            if p is not None:
+                node = _node(memo, ProbGate, p,
+                             compile_body(match.group(5), memo))
+        elif match.group(6) is not None:
+            node = _node(memo, SymbolRef, sys.intern(match.group(6)))
+        else:
+            node = _node(memo, VarRef, sys.intern(match.group(7)))
+        if node is None:
+            continue
+        if start > position:
+            nodes.append(_node(memo, Literal, string[position:start]))
+        nodes.append(node)
+        position = end
+    if position < len(string):
+        nodes.append(_node(memo, Literal, string[position:]))
+    return tuple(nodes)
+
+
+def compile_template(string, memo=None):
+    """Compile a template string into a tuple of expansion nodes.
+
+    Assignments come first, in the order the string-rewriting parser
+    performs them, followed by the body of the template.
+
+    memo: dict (default None)
+      if given, identical templates and nodes compiled with the same memo
+      are shared instead of being built again.
+    """
+    if memo is not None and string in memo:
+        return memo[string]
+    template = string
+    nodes = []
+    for match in var_assign_hook.finditer(string):
+        nodes.append(_node(memo, VarAssign, sys.intern(match.group(2)),
+                           match.group(3)))
+        string = string.replace(match.group(0), '', 1)
+
+    match = var_lazy_assign_hook.search(string)
+    if match:
+        string = string[:match.start()]
+        nodes.append(_node(memo, LazyAssign, sys.intern(match.group(1)),
+                           string))
+
+    nodes.extend(compile_body(string, memo))
+    nodes = tuple(nodes)
+    if memo is not None:
+        memo[template] = nodes
+    return nodes
+
+
+def compile_entry(string, memo=None):
+    """Compile a definition line into a tuple of expansion nodes, or return
+    the line itself if it is plain text.
+    """
+    if not special_hook.search(string):
+        return string
+    nodes = compile_template(string, memo)
+    if len(nodes) == 1 and nodes[0].__class__ is Literal:
+        return string
+    return nodes
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""Per-generation state for expanding a shared grammar.
+
+A loaded Grammar only holds what every generation reads: the symbols, their
+compiled entries and alias tables. Everything a generation changes lives in
+a Context: the values of its variables and its random source. Any number of
+contexts can expand the same grammar at once, from several threads or
+asyncio tasks, without copying or locking the loaded grammar; a context is a
+few references and a dict of variables.
+
+An expansion given a nimrod.budget.Budget, or made from a grammar that has
+one, is walked by iter_budgeted() instead, which checks the limits as it
+goes.
+"""
+import random
+import time
+
+from .budget import FALLBACK, RAISE, BudgetExceeded
+from .compiler import SymbolRef, VarRef
+
+
+class Context(object):
+    """Variables and random source of one line of generation from grammar.
+
+    OPTIONAL ARGUMENTS:
+    rng: object with a random() method (default the random module)
+      source of uniform floats for every random decision
+    variables: dict (default None)
+      initial variable values; the dict is used, not copied
+    """
+
+    def __init__(self, grammar, rng=None, variables=None):
+        self.grammar = grammar
+        self.rng = random if rng is None else rng
+        self.variables = {} if variables is None else variables
+        # statistics are counted into the metrics the grammar had when the
+        # context was made
+        self.metrics = grammar.metrics
+        if self.metrics is not None:
+            self.step_symbol = self._counted_step_symbol
+            self.gate = self._counted_gate
+        # and into its profile
+        self.profiling = grammar.profiling
+        if self.profiling is not None:
+            self.expand_nodes = self._profiled_expand_nodes
+            # the stack of symbols being expanded and the time spent in the
+            # symbols it refers to
+            self.stack = ''
+            self.child_time = 0.0
+
+    def ref(self, var):
+        """Return the stored value of $var."""
+        if var in self.variables:
+            return self.variables[var]
+        else:
+            return ''
+
+    def reset(self):
+        """Clear all stored variable values."""
+        self.variables = {}
+
+    def interpret(self, symbol, parse=True, depth=0, budget=None):
+        """Return a random element of {symbol}, see Grammar.interpret()."""
+        grammar = self.grammar
+        if symbol not in grammar.symbols:
+            if (symbol not in grammar.pending
+                    or grammar.load_symbol(symbol) is None):
+                return '{'+symbol+'}'
+        if not parse:
+            entries = grammar.symbols[symbol]
+            return entries[self.choose(symbol, len(entries))]
+        entries = grammar.compiled.get(symbol)
+        if entries is None:
+            # refused as nonterminating
+            return '{'+symbol+'}'
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        if budget is None:
+            budget = self.grammar.budget
+        if (budget is not None or self.profiling is not None
+                or metrics is not None):
+            # walk the reference so that it is held to the budget, profiled
+            # or counted like any other
+            result = self.expand((SymbolRef(symbol),), depth, budget)
+        else:
+            entry = entries[self.choose(symbol, len(entries))]
+            if entry.__class__ is str:
+                result = entry
+            else:
+                out = []
+                self.expand_nodes(entry, out, depth)
+                result = ''.join(out)
+        if metrics is not None:
+            self._record_generations(1, start)
+        return result
+
+    def parse(self, string, depth=0, budget=None, **kwargs):
+        """Expand a template string, see Grammar.parse()."""
+        # make sure we have the most up-to-date definition file
+        self.grammar.check_file()
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+
+        string = self.expand(self.grammar.compile(string), depth, budget)
+
+        # include optional variable replacement {keyword}
+        if kwargs:
+            string = string.format(**kwargs)
+
+        if metrics is not None:
+            self._record_generations(1, start)
+        return string
+
+    def generate(self, symbol, n, budget=None):
+        """Return a list of n random expansions of {symbol}, each held to
+        budget on its own.
+        """
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        if budget is None:
+            budget = self.grammar.budget
+        nodes = (SymbolRef(symbol),)
+        results = []
+        for _ in range(n):
+            results.append(self.expand(nodes, 0, budget))
+        if metrics is not None:
+            self._record_generations(n, start)
+        return results
+
+    def iter_expand(self, symbol, budget=None):
+        """Yield a random expansion of {symbol} fragment by fragment, see
+        Grammar.iter_expand().
+        """
+        if budget is None:
+            budget = self.grammar.budget
+        if budget is None:
+            pieces = self.iter_nodes((SymbolRef(symbol),), 0)
+        else:
+            pieces = self._iter_within((SymbolRef(symbol),), budget)
+        if self.metrics is not None:
+            return self._iter_counted(pieces)
+        return pieces
+
+    def _iter_counted(self, pieces):
+        # a stream counts as a generation once it is used up; its time
+        # includes the time its reader spends between pieces
+        start = time.perf_counter()
+        for piece in pieces:
+            yield piece
+        self._record_generations(1, start)
+
+    def _iter_within(self, nodes, budget):
+        # what was yielded cannot be taken back, so a stream simply ends
+        # when its budget runs out unless the policy is to raise
+        try:
+            for piece in self.iter_budgeted(nodes, 0, budget):
+                yield piece
+        except BudgetExceeded:
+            if budget.policy == RAISE:
+                raise
+
+    def expand(self, nodes, depth, budget=None):
+        """Return the expansion of a tuple of compiled nodes, held to
+        budget if it is not None.
+        """
+        out = []
+        if budget is None:
+            self.expand_nodes(nodes, out, depth)
+            return ''.join(out)
+        try:
+            for piece in self.iter_budgeted(nodes, depth, budget):
+                out.append(piece)
+        except BudgetExceeded as exceeded:
+            if budget.policy == RAISE:
+                exceeded.partial = ''.join(out)
+                raise
+            if budget.policy == FALLBACK:
+                return budget.fallback
+        return ''.join(out)
+
+    def _record_generations(self, count, start):
+        self.metrics.generations += count
+        self.metrics.generation_time += time.perf_counter() - start
+
+    def choose(self, symbol, count):
+        """Return the index of a random entry of symbol, honoring weights."""
+        table = self.grammar.alias_tables.get(symbol)
+        if table is None:
+            return int(self.rng.random() * count)
+        return table.pick(self.rng.random())
+
+    def expand_nodes(self, nodes, out, depth):
+        """Append the expansion of a tuple of compiled nodes to out."""
+        for node in nodes:
+            step = node.step(self, depth)
+            if step.__class__ is str:
+                out.append(step)
+            elif step is not None:
+                self.expand_nodes(step[0], out, step[1])
+
+    def iter_nodes(self, nodes, depth):
+        """Yield the expansion of a tuple of compiled nodes piece by piece."""
+        # the same walk as expand_nodes, with an explicit stack
+        stack = [(iter(nodes), depth)]
+        while stack:
+            nodes, depth = stack[-1]
+            for node in nodes:
+                step = node.step(self, depth)
+                if step.__class__ is str:
+                    yield step
+                elif step is not None:
+                    stack.append((iter(step[0]), step[1]))
+                    break
+            else:
+                stack.pop()
+
+    def iter_budgeted(self, nodes, depth, budget):
+        """Yield the expansion of nodes like iter_nodes(), raising
+        BudgetExceeded as soon as budget is used up. The piece of text that
+        goes over max_chars is cut to fit and yielded first.
+        """
+        max_chars = budget.max_chars
+        max_expansions = budget.max_expansions
+        max_depth = budget.max_depth
+        if budget.deadline is not None:
+            deadline = time.monotonic() + budget.deadline
+        else:
+            deadline = None
+        chars = 0
+        expansions = 0
+        stack = [(iter(nodes), depth)]
+        while stack:
+            nodes, depth = stack[-1]
+            for node in nodes:
+                if node.__class__ is SymbolRef or node.__class__ is VarRef:
+                    expansions += 1
+                    if (max_expansions is not None
+                            and expansions > max_expansions):
+                        raise BudgetExceeded('expansions')
+                    if max_depth is not None and depth >= max_depth:
+                        raise BudgetExceeded('depth')
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise BudgetExceeded('deadline')
+                step = node.step(self, depth)
+                if step.__class__ is str:
+                    chars += len(step)
+                    if max_chars is not None and chars > max_chars:
+                        yield step[:len(step) - (chars - max_chars)]
+                        raise BudgetExceeded('chars')
+                    yield step
+                elif step is not None:
+                    stack.append((iter(step[0]), step[1]))
+                    break
+            else:
+                stack.pop()
+
+    def step_symbol(self, symbol, depth):
+        """Return the text or (nodes, depth) a reference to symbol at depth
+        expands to.
+        """
+        grammar = self.grammar
+        entries = grammar.compiled.get(symbol)
+        if entries is None and symbol in grammar.pending:
+            entries = grammar.load_symbol(symbol)
+        if entries is None or depth >= grammar.max_depth:
+            return '{'+symbol+'}'
+        entry = entries[self.choose(symbol, len(entries))]
+        if entry.__class__ is str:
+            # plain text
+            return entry
+        return entry, depth + 1
+
+    def step_variable(self, var, depth):
+        """Return None or the text or (nodes, depth) a reference to $var at
+        depth expands to.
+        """
+        value = self.ref(var)
+        if not value:
+            return None
+        grammar = self.grammar
+        if depth >= grammar.max_depth:
+            # a value that refers to itself
+            return '$' + var
+        return grammar.compile(value), depth + 1
+
+    def gate(self, p):
+        """Return True with probability p."""
+        return self.rng.random() < p
+
+    # replacements for step_symbol and gate while statistics are enabled
+
+    def _counted_step_symbol(self, symbol, depth):
+        step = type(self).step_symbol(self, symbol, depth)
+        grammar = self.grammar
+        if symbol in grammar.compiled and depth < grammar.max_depth:
+            self.metrics.expansions[symbol] += 1
+            self.metrics.depths[depth] += 1
+        return step
+
+    def _counted_gate(self, p):
+        if type(self).gate(self, p):
+            self.metrics.gates_taken += 1
+            return True
+        self.metrics.gates_skipped += 1
+        return False
+
+    # replacement for expand_nodes while profiling is enabled
+
+    def _profiled_expand_nodes(self, nodes, out, depth):
+        profiling = self.profiling
+        for node in nodes:
+            if node.__class__ is not SymbolRef:
+                step = node.step(self, depth)
+                if step.__class__ is str:
+                    out.append(step)
+                    if self.stack:
+                        profiling.chars[self.stack] += len(step)
+                elif step is not None:
+                    self._profiled_expand_nodes(step[0], out, step[1])
+                continue
+            outer = self.stack
+            outer_time = self.child_time
+            stack = outer + ';' + node.name if outer else node.name
+            self.stack = stack
+            self.child_time = 0.0
+            start = time.perf_counter()
+            try:
+                step = node.step(self, depth)
+                if step.__class__ is str:
+                    out.append(step)
+                    profiling.chars[stack] += len(step)
+                elif step is not None:
+                    self._profiled_expand_nodes(step[0], out, step[1])
+            finally:
+                elapsed = time.perf_counter() - start
+                profiling.time[stack] += elapsed - self.child_time
+                profiling.calls[stack] += 1
+                self.stack = outer
+                self.child_time = outer_time + elapsed
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Counting and numbering the derivations of a compiled grammar.
+
+A derivation is one complete set of choices: an entry for every symbol that
+is expanded and a branch for every gate. <p|string> and <p|A|B> always count
+as two branches, whatever p is. Derivations of a symbol are numbered from 0
+in a stable order: entries in definition order, taken gate branches before
+skipped ones, and earlier parts of an entry varying slowest.
+"""
+from .compiler import (EitherOr, LazyAssign, Literal, ProbGate, SymbolRef,
+                       VarAssign, VarRef, compile_template)
+from .store import TextTable
+
+
+class Derivations(object):
+    """Derivation counts of the symbols in a dict of compiled entries,
+    memoized per symbol.
+    """
+
+    def __init__(self, compiled, max_depth=100):
+        self.compiled = compiled
+        # variables nested deeper than this are left unexpanded
+        self.max_depth = max_depth
+        self.counts = {}
+        self.visiting = set()
+
+    def symbol_count(self, symbol):
+        """Return the number of derivations of symbol.
+
+        Raises ValueError if symbol can expand into itself, since it then
+        has infinitely many derivations.
+        """
+        count = self.counts.get(symbol)
+        if count is not None:
+            return count
+        entries = self.compiled.get(symbol)
+        if entries is None:
+            # undefined symbols expand to themselves
+            return 1
+        if symbol in self.visiting:
+            raise ValueError('{' + symbol + '} can expand into itself and '
+                             'has infinitely many derivations')
+        if isinstance(entries, TextTable):
+            # plain text entries have one derivation each
+            count = len(entries)
+            self.counts[symbol] = count
+            return count
+        self.visiting.add(symbol)
+        try:
+            count = sum(self.sequence_count(entry) for entry in entries)
+        finally:
+            self.visiting.discard(symbol)
+        self.counts[symbol] = count
+        return count
+
+    def sequence_count(self, nodes):
+        count = 1
+        if nodes.__class__ is str:
+            return count
+        for node in nodes:
+            count *= self.node_count(node)
+        return count
+
+    def node_count(self, node):
+        cls = node.__class__
+        if cls is SymbolRef:
+            return self.symbol_count(node.name)
+        if cls is ProbGate:
+            return self.sequence_count(node.body) + 1
+        if cls is EitherOr:
+            return (self.sequence_count(node.first)
+                    + self.sequence_count(node.second))
+        return 1
+
+    def render_symbol(self, symbol, index, out, variables, depth=0):
+        """Append derivation number index of symbol to out."""
+        entries = self.compiled.get(symbol)
+        if entries is None:
+            out.append('{' + symbol + '}')
+            return
+        if isinstance(entries, TextTable):
+            out.append(entries[index])
+            return
+        for entry in entries:
+            count = self.sequence_count(entry)
+            if index < count:
+                self.render_sequence(entry, index, out, variables, depth)
+                return
+            index -= count
+        raise IndexError('derivation index out of range')
+
+    def render_sequence(self, nodes, index, out, variables, depth=0):
+        if nodes.__class__ is str:
+            out.append(nodes)
+            return
+        counts = [self.node_count(node) for node in nodes]
+        # the number of derivations of everything after each node
+        below = [1] * len(nodes)
+        for i in range(len(nodes) - 2, -1, -1):
+            below[i] = below[i + 1] * counts[i + 1]
+        for node, radix in zip(nodes, below):
+            choice, index = divmod(index, radix)
+            self.render_node(node, choice, out, variables, depth)
+
+    def render_node(self, node, index, out, variables, depth=0):
+        cls = node.__class__
+        if cls is Literal:
+            out.append(node.text)
+        elif cls is SymbolRef:
+            self.render_symbol(node.name, index, out, variables, depth)
+        elif cls is ProbGate:
+            taken = self.sequence_count(node.body)
+            if index < taken:
+                self.render_sequence(node.body, index, out, variables, depth)
+        elif cls is EitherOr:
+            first = self.sequence_count(node.first)
+            if index < first:
+                self.render_sequence(node.first, index, out, variables, depth)
+            else:
+                self.render_sequence(node.second, index - first, out,
+                                     variables, depth)
+        elif cls is VarAssign or cls is LazyAssign:
+            variables[node.name] = node.value
+        elif cls is VarRef:
+            # variable values are not part of the numbering: use their first
+            # derivation
+            value = variables.get(node.name)
+            if not value:
+                return
+            if depth >= self.max_depth:
+                # a value that refers to itself stops here, as it does
+                # when generating
+                out.append('$' + node.name)
+                return
+            self.render_sequence(compile_template(value), 0, out,
+                                 variables, depth + 1)
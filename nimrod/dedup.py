@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Filters for removing repeated outputs from long generation runs.
+
+Strings are reduced to a 128-bit digest before they are remembered, so
+memory never depends on the length of the outputs. A BloomFilter uses a
+fixed amount of memory chosen from its capacity and false positive rate; a
+DigestSet is exact up to collisions of 64-bit digests but grows with the
+number of distinct outputs.
+"""
+import hashlib
+import math
+
+
+def digest(text):
+    """Return the 128-bit digest a filter remembers text by."""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+class DigestSet(object):
+    """Exact membership of 64-bit digests."""
+
+    def __init__(self):
+        self.digests = set()
+
+    def add(self, key):
+        """Remember the digest key; return False if it was already there."""
+        value = int.from_bytes(key[:8], 'little')
+        if value in self.digests:
+            return False
+        self.digests.add(value)
+        return True
+
+    def __contains__(self, key):
+        return int.from_bytes(key[:8], 'little') in self.digests
+
+    def __len__(self):
+        return len(self.digests)
+
+
+class BloomFilter(object):
+    """Approximate membership in a fixed-size bit array.
+
+    Sized so that after capacity distinct items a new item is wrongly
+    reported as seen with probability error_rate. A wrongly reported item is
+    dropped as a duplicate; a repeated item is never let through.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        if capacity <= 0 or not 0 < error_rate < 1:
+            raise ValueError('capacity must be positive and error_rate '
+                             'between 0 and 1')
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate)
+                                  / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def add(self, key):
+        """Remember the digest key; return False if it was probably already
+        there.
+        """
+        h1 = int.from_bytes(key[:8], 'little')
+        h2 = int.from_bytes(key[8:16], 'little') | 1
+        bits = self.bits
+        size = self.size
+        new = False
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % size
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, key):
+        h1 = int.from_bytes(key[:8], 'little')
+        h2 = int.from_bytes(key[8:16], 'little') | 1
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % self.size
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def memory(self):
+        """Bytes used by the bit array."""
+        return len(self.bits)
+
+
+class Deduplicator(object):
+    """Let each distinct string through once, counting the duplicates."""
+
+    def __init__(self, seen=None):
+        self.seen = DigestSet() if seen is None else seen
+        self.total = 0
+        self.duplicates = 0
+
+    @classmethod
+    def exact(cls):
+        """Deduplicate exactly with a set of 64-bit digests."""
+        return cls(DigestSet())
+
+    @classmethod
+    def bloom(cls, capacity, error_rate=0.001):
+        """Deduplicate in fixed memory with a Bloom filter."""
+        return cls(BloomFilter(capacity, error_rate))
+
+    def add(self, text):
+        """Return True the first time text is added, False afterwards."""
+        self.total += 1
+        if self.seen.add(digest(text)):
+            return True
+        self.duplicates += 1
+        return False
+
+    def unique(self, iterable):
+        """Yield the strings of iterable that were not seen before."""
+        for text in iterable:
+            if self.add(text):
+                yield text
+
+    @property
+    def duplicate_rate(self):
+        """Fraction of the strings added so far that were dropped."""
+        if not self.total:
+            return 0.0
+        return self.duplicates / float(self.total)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""The index of a grammar that is loaded lazily.
+
+Before anything is parsed, every file reachable through #import is scanned
+for the symbols it defines and the files it imports. Only the lines holding
+a '#' are looked at: the file is mapped into memory and searched as bytes,
+so the rest of its text is never decoded or split. Files are then parsed one
+at a time, the first time one of their symbols is needed.
+"""
+import mmap
+import re
+
+from .wordlist import wordlist_hook
+
+# lines holding a symbol name, an #import or a #wordlist, as the parser
+# reads them
+key_line_hook = re.compile(br'^[^\n]*#[^\n]*', re.M)
+import_hook = re.compile(r'#import ([\w\.]+)')
+
+
+def scan_file(path):
+    """Return a tuple of the symbols defined in the file at path and a tuple
+    of the files it imports.
+    """
+    keys = {}
+    imports = []
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files cannot be mapped
+            return (), ()
+        try:
+            for match in key_line_hook.finditer(data):
+                line = match.group(0).decode('utf-8').rstrip()
+                import_match = import_hook.search(line)
+                wordlist_match = wordlist_hook.search(line)
+                if import_match:
+                    imports.append(import_match.group(1))
+                elif wordlist_match:
+                    keys[wordlist_match.group(1)] = None
+                else:
+                    keys[line[1:]] = None
+        finally:
+            data.close()
+    return tuple(keys), tuple(imports)
+
+
+def scan(path, resolve):
+    """Return a list of (path, keys, imports) for the file at path and every
+    file it imports, in the order Grammar.load() reads them. resolve(name,
+    relative_to) turns an #import into a path.
+    """
+    files = []
+    seen = set()
+    pending = [path]
+    while pending:
+        path = pending.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        keys, imports = scan_file(path)
+        files.append((path, keys, imports))
+        # depth first, in the order of the #import lines
+        for name in reversed(imports):
+            pending.append(resolve(name, relative_to=path))
+    return files
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""Output lengths of a compiled grammar, and sampling by length.
+
+A LengthModel gives, for every symbol, the probability of each output length
+up to a limit, under the random choices generation makes: entry weights and
+gate probabilities. Lengths are counted in characters. Symbols that can
+expand into themselves are solved by expanding them one more level at a
+time, up to the grammar's max_depth.
+
+To draw an expansion whose length falls in a range, a length is first drawn
+from the symbol's distribution restricted to the range. Every choice on the
+way down, an entry, a gate branch or the length of each part of an entry, is
+then drawn conditioned on the length still to be produced, so the expansion
+comes out exactly that long and is never thrown away. Its probability is the
+one generation would give it, given that its length falls in the range.
+
+A $variable is taken to hold any of the values assigned to it anywhere in
+the grammar, all as likely. When the value it actually holds is longer or
+shorter, the parts that follow aim for the length that is left.
+"""
+from .analysis import references, strongly_connected
+from .compiler import (EitherOr, LazyAssign, Literal, ProbGate, SymbolRef,
+                       VarAssign, VarRef, compile_template)
+from .store import TextTable
+
+EMPTY = {0: 1.0}
+
+
+def convolve(a, b, limit):
+    """Return the distribution of the sum of two independent lengths, leaving
+    out sums over limit.
+    """
+    if len(b) == 1:
+        a, b = b, a
+    if len(a) == 1:
+        for shift, p in a.items():
+            return dict((length + shift, p * q) for length, q in b.items()
+                        if length + shift <= limit)
+    out = {}
+    for i, p in a.items():
+        for j, q in b.items():
+            if i + j <= limit:
+                out[i + j] = out.get(i + j, 0.0) + p * q
+    return out
+
+
+def mix(weighted):
+    """Return the mixture of a list of (weight, distribution)."""
+    out = {}
+    for weight, dist in weighted:
+        if weight > 0:
+            for length, p in dist.items():
+                out[length] = out.get(length, 0.0) + weight * p
+    return out
+
+
+def pick(weights, u):
+    """Return an index of weights, chosen in proportion to its weight, for a
+    uniform float 0 <= u < 1.
+    """
+    u *= sum(weights)
+    last = 0
+    for i, weight in enumerate(weights):
+        if weight > 0:
+            if u < weight:
+                return i
+            u -= weight
+            last = i
+    # rounding error
+    return last
+
+
+class LengthModel(object):
+    """Length distributions of the symbols in a dict of compiled entries,
+    computed on demand and memoized, for lengths up to limit.
+    """
+
+    def __init__(self, compiled, alias_tables, limit, max_depth=100):
+        self.compiled = compiled
+        self.alias_tables = alias_tables
+        self.limit = limit
+        self.max_depth = max_depth
+        self.symbols = {}
+        # id of compiled nodes -> (nodes, distribution or suffixes), the
+        # nodes kept so that their ids stay unique
+        self.nodes = {}
+        self.suffixes = {}
+        # symbol -> probability of each entry, None if they are all equal
+        self.weights = {}
+        # variable -> compiled values assigned to it anywhere, found on
+        # first use, and the length distribution of the variable
+        self.assignments = None
+        self.variables = {}
+        # symbol -> length -> indices of the plain lines of that length
+        self.lines = {}
+
+    def symbol(self, symbol):
+        """Return the distribution of the output length of symbol as a dict
+        of length -> probability. Probabilities of lengths over limit, and
+        of expansions nested deeper than max_depth, are left out.
+        """
+        dist = self.symbols.get(symbol)
+        if dist is None:
+            if symbol not in self.compiled:
+                # undefined symbols expand to themselves
+                return convolve({len(symbol) + 2: 1.0}, EMPTY, self.limit)
+            self._solve(symbol)
+            dist = self.symbols[symbol]
+        return dist
+
+    def _solve(self, root):
+        # the symbols root needs that are not solved yet, leaves first
+        graph = {}
+        pending = [root]
+        while pending:
+            symbol = pending.pop()
+            if symbol in graph or symbol in self.symbols:
+                continue
+            refs = set()
+            entries = self.compiled[symbol]
+            if not isinstance(entries, TextTable):
+                for entry in set(entries):
+                    references(entry, refs)
+            graph[symbol] = refs
+            pending.extend(ref for ref in refs if ref in self.compiled)
+        for component in strongly_connected(graph):
+            symbol = component[0]
+            if len(component) == 1 and symbol not in graph[symbol]:
+                self.symbols[symbol] = self._symbol_step(symbol)
+                continue
+            # no expansions yet, then one more level of nesting each round
+            for symbol in component:
+                self.symbols[symbol] = {}
+            for _ in range(self.max_depth):
+                self._forget()
+                solved = dict((symbol, self._symbol_step(symbol))
+                              for symbol in component)
+                if all(solved[symbol] == self.symbols[symbol]
+                       for symbol in component):
+                    break
+                self.symbols.update(solved)
+            self._forget()
+
+    def _forget(self):
+        # drop memoized nodes, which may depend on symbols being solved
+        self.nodes.clear()
+        self.suffixes.clear()
+        self.variables.clear()
+
+    def entry_weights(self, symbol):
+        """Return the probability of choosing each entry of symbol, or None
+        if every entry is as likely.
+        """
+        if symbol not in self.weights:
+            table = self.alias_tables.get(symbol)
+            self.weights[symbol] = (None if table is None
+                                    else table.probabilities())
+        return self.weights[symbol]
+
+    def _symbol_step(self, symbol):
+        entries = self.compiled[symbol]
+        weights = self.entry_weights(symbol)
+        if weights is None:
+            weights = [1.0 / len(entries)] * len(entries)
+        if isinstance(entries, TextTable):
+            dist = {}
+            for weight, line in zip(weights, entries):
+                if len(line) <= self.limit:
+                    dist[len(line)] = dist.get(len(line), 0.0) + weight
+            return dist
+        return mix([(weight, self.sequence(entry))
+                    for weight, entry in zip(weights, entries)])
+
+    def sequence(self, nodes):
+        """Return the length distribution of a tuple of compiled nodes."""
+        return self._suffixes(nodes)[0]
+
+    def _suffixes(self, nodes):
+        # the length distribution of nodes[i:] for every i
+        memo = self.suffixes.get(id(nodes))
+        if memo is not None:
+            return memo[1]
+        if nodes.__class__ is str:
+            suffixes = [convolve({len(nodes): 1.0}, EMPTY, self.limit)]
+        else:
+            suffixes = [EMPTY]
+            for node in reversed(nodes):
+                suffixes.append(convolve(self.node(node), suffixes[-1],
+                                         self.limit))
+            suffixes.reverse()
+        self.suffixes[id(nodes)] = (nodes, suffixes)
+        return suffixes
+
+    def node(self, node):
+        """Return the length distribution of one compiled node."""
+        cls = node.__class__
+        if cls is SymbolRef:
+            return self.symbol(node.name)
+        if cls is Literal:
+            return {len(node.text): 1.0}
+        if cls is VarRef:
+            return self.variable(node.name)
+        if cls is not ProbGate and cls is not EitherOr:
+            # assignments
+            return EMPTY
+        memo = self.nodes.get(id(node))
+        if memo is not None:
+            return memo[1]
+        if cls is ProbGate:
+            dist = mix([(node.p, self.sequence(node.body)),
+                        (1.0 - node.p, EMPTY)])
+        else:
+            dist = mix([(node.p, self.sequence(node.first)),
+                        (1.0 - node.p, self.sequence(node.second))])
+        self.nodes[id(node)] = (node, dist)
+        return dist
+
+    def render_symbol(self, symbol, length, context, out):
+        """Append a random expansion of symbol that is length characters
+        long to out, with variables and random source from context, and
+        return the number of characters appended. Variables can make the
+        expansion longer or shorter than length.
+        """
+        entries = self.compiled.get(symbol)
+        if entries is None:
+            text = '{' + symbol + '}'
+            out.append(text)
+            return len(text)
+        weights = self.entry_weights(symbol)
+        if isinstance(entries, TextTable):
+            lines = self._lines(symbol).get(length)
+            if lines is None:
+                # no line is that long, see render_sequence()
+                lines = range(len(entries))
+            if weights is None:
+                index = lines[int(context.rng.random() * len(lines))]
+            else:
+                index = lines[pick([weights[i] for i in lines],
+                                   context.rng.random())]
+            out.append(entries[index])
+            return len(entries[index])
+        if weights is None:
+            weights = [1.0] * len(entries)
+        index = pick([weight * self.sequence(entry).get(length, 0.0)
+                      for weight, entry in zip(weights, entries)],
+                     context.rng.random())
+        return self.render_sequence(entries[index], length, context, out)
+
+    def _lines(self, symbol):
+        lines = self.lines.get(symbol)
+        if lines is None:
+            lines = {}
+            for index, line in enumerate(self.compiled[symbol]):
+                lines.setdefault(len(line), []).append(index)
+            self.lines[symbol] = lines
+        return lines
+
+    def render_sequence(self, nodes, length, context, out):
+        if nodes.__class__ is str:
+            out.append(nodes)
+            return len(nodes)
+        suffixes = self._suffixes(nodes)
+        last = len(nodes) - 1
+        produced = 0
+        for i, node in enumerate(nodes):
+            dist = self.node(node)
+            remaining = length - produced
+            total = suffixes[i].get(remaining, 0.0)
+            if i == last and total > 0:
+                part = remaining
+            elif total > 0:
+                part = self._split(dist, suffixes[i + 1], total, remaining,
+                                   context.rng.random())
+            else:
+                # variables made the text so far longer or shorter than
+                # planned, and what is left cannot be hit: choose freely
+                part = self._split(dist, None, sum(dist.values()),
+                                   self.limit, context.rng.random())
+            produced += self.render_node(node, part, context, out)
+        return produced
+
+    def variable(self, name):
+        """Return the length distribution of $name, taken to be any of
+        the values assigned to it in the grammar, all as likely.
+        """
+        dist = self.variables.get(name)
+        if dist is None:
+            # a value that refers to the variable itself counts it as empty
+            self.variables[name] = EMPTY
+            if self.assignments is None:
+                self.assignments = {}
+                for entries in self.compiled.values():
+                    if not isinstance(entries, TextTable):
+                        for entry in set(entries):
+                            self._find_assignments(entry)
+            values = self.assignments.get(name)
+            if values:
+                dist = mix([(1.0 / len(values), self.sequence(value))
+                            for value in values])
+            else:
+                dist = EMPTY
+            self.variables[name] = dist
+        return dist
+
+    def _find_assignments(self, nodes):
+        if nodes.__class__ is str:
+            return
+        for node in nodes:
+            cls = node.__class__
+            if cls is VarAssign or cls is LazyAssign:
+                self.assignments.setdefault(node.name, []).append(
+                    compile_template(node.value))
+            elif cls is ProbGate:
+                self._find_assignments(node.body)
+            elif cls is EitherOr:
+                self._find_assignments(node.first)
+                self._find_assignments(node.second)
+
+    def _split(self, dist, rest, total, length, u):
+        # draw the length of a node followed by nodes of length distribution
+        # rest, together length long with probability total; with no rest,
+        # draw it from dist alone
+        if len(dist) == 1:
+            for part in dist:
+                return part
+        u *= total
+        chosen = 0
+        for part, p in dist.items():
+            if part <= length:
+                weight = p if rest is None else p * rest.get(length - part,
+                                                             0.0)
+                if weight > 0:
+                    chosen = part
+                    u -= weight
+                    if u < 0:
+                        break
+        return chosen
+
+    def render_node(self, node, length, context, out):
+        cls = node.__class__
+        if cls is Literal:
+            out.append(node.text)
+            return len(node.text)
+        if cls is SymbolRef:
+            return self.render_symbol(node.name, length, context, out)
+        if cls is ProbGate:
+            taken = node.p * self.sequence(node.body).get(length, 0.0)
+            skipped = (1.0 - node.p) if length == 0 else 0.0
+            if pick([taken, skipped], context.rng.random()) == 0:
+                return self.render_sequence(node.body, length, context, out)
+            return 0
+        if cls is EitherOr:
+            first = node.p * self.sequence(node.first).get(length, 0.0)
+            second = (1.0 - node.p) * self.sequence(node.second).get(length,
+                                                                     0.0)
+            if pick([first, second], context.rng.random()) == 0:
+                return self.render_sequence(node.first, length, context, out)
+            return self.render_sequence(node.second, length, context, out)
+        if cls is VarAssign or cls is LazyAssign:
+            context.variables[node.name] = node.value
+            return 0
+        if cls is VarRef:
+            text = context.expand((node,), 0)
+            out.append(text)
+            return len(text)
+        return 0
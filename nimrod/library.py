@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Many grammars loaded together, sharing the files they import.
+
+A GrammarLibrary first finds every file reachable from the grammars it is
+asked to load, then reads each of those files exactly once with a pool of
+threads or processes, however many grammars import it. Every grammar is then
+assembled from the shared definitions (see nimrod.store) without reading
+anything again. view() combines any of the loaded grammars into one for
+generation, sharing their definitions rather than copying them.
+"""
+import concurrent.futures
+import os
+
+from .cache import file_key
+from .lazy import scan
+from .nimrod import Grammar
+from .reload import NoReload
+from . import store
+
+
+# the grammar that reads files inside each worker process
+_worker_grammar = None
+
+
+def _init_worker(cls):
+    global _worker_grammar
+    _worker_grammar = cls(reload_policy=NoReload())
+
+
+def _read(path):
+    stamp = file_key(path)
+    source, imports = _worker_grammar._build_source(path)
+    return stamp, source, imports
+
+
+class GrammarLibrary(object):
+    """Grammars by name, the file name without its directory and extension.
+
+    OPTIONAL ARGUMENTS:
+    grammar_class: class (default Grammar)
+      class of the loaded grammars and views
+    """
+
+    def __init__(self, grammar_class=Grammar):
+        self.grammar_class = grammar_class
+        self.grammars = {}
+        # views by the tuple of names they combine
+        self.views = {}
+
+    def __getitem__(self, name):
+        return self.grammars[name]
+
+    def __contains__(self, name):
+        return name in self.grammars
+
+    def __len__(self):
+        return len(self.grammars)
+
+    def names(self):
+        """Return the sorted names of the loaded grammars."""
+        return sorted(self.grammars)
+
+    def load_directory(self, directory, workers=None, processes=True):
+        """Load every .txt file in directory as a grammar, see load()."""
+        paths = [os.path.join(directory, name)
+                 for name in sorted(os.listdir(directory))
+                 if name.endswith('.txt')]
+        return self.load(paths, workers, processes)
+
+    def load(self, paths, workers=None, processes=True):
+        """Load the grammar files at paths, with every file they import, and
+        return the library.
+
+        OPTIONAL ARGUMENTS:
+        workers: int (default the number of CPUs)
+          size of the pool that reads the files
+        processes: bool (default True)
+          read files in worker processes rather than threads. Reading is
+          CPU-bound, so threads only help while files are read from a slow
+          disk; processes read in parallel, but send what they read back by
+          pickling it.
+        """
+        prototype = self.grammar_class(reload_policy=NoReload())
+        roots = [prototype._resolve(path) for path in paths]
+        files = set()
+        for root in roots:
+            if root not in files:
+                files.update(path for path, keys, imports
+                             in scan(root, prototype._resolve))
+        self._read_files(sorted(files), workers, processes)
+        for root in roots:
+            name = os.path.splitext(os.path.basename(root))[0]
+            grammar = self.grammar_class()
+            grammar.load(root)
+            self.grammars[name] = grammar
+        self.views = {}
+        return self
+
+    def _read_files(self, paths, workers, processes):
+        """Read each file in paths into the shared store."""
+        cls = self.grammar_class
+        # files read by earlier loads are not read again
+        paths = [path for path in paths if not store.is_current(path, cls)]
+        if not paths:
+            return
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(paths)))
+        reader = cls(reload_policy=NoReload())
+        if workers == 1:
+            for path in paths:
+                store.shared_source(path, cls, reader._build_source)
+            return
+        if processes:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers, initializer=_init_worker,
+                    initargs=(cls,)) as pool:
+                for path, (stamp, source, imports) in zip(
+                        paths, pool.map(_read, paths, chunksize=8)):
+                    store.share(path, cls, stamp, source, imports)
+            return
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers) as pool:
+            for future in [pool.submit(store.shared_source, path, cls,
+                                       reader._build_source)
+                           for path in paths]:
+                future.result()
+
+    def view(self, names):
+        """Return one grammar holding the symbols of every grammar in
+        names, merged as if one file imported all of them.
+
+        Views share the definitions of the library's grammars and are kept,
+        so asking for the same names again returns the same grammar.
+        """
+        names = tuple(names)
+        view = self.views.get(names)
+        if view is None:
+            view = self.grammar_class()
+            view.include(*[self.grammars[name] for name in names])
+            self.views[names] = view
+        return view
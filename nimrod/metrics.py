@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""Counters collected by a grammar while statistics are enabled."""
+import collections
+
+
+class Metrics(object):
+    """Generation counters for one grammar.
+
+    expansions: symbol -> number of times it was expanded
+    depths: depth -> number of symbol expansions at that depth
+    """
+
+    def __init__(self):
+        self.expansions = collections.Counter()
+        self.depths = collections.Counter()
+        self.gates_taken = 0
+        self.gates_skipped = 0
+        self.reloads = 0
+        self.generations = 0
+        self.generation_time = 0.0
+
+    def as_dict(self):
+        """Return a snapshot of the counters as plain dicts and numbers."""
+        return {
+            'expansions': dict(self.expansions),
+            'depths': dict(self.depths),
+            'gates_taken': self.gates_taken,
+            'gates_skipped': self.gates_skipped,
+            'reloads': self.reloads,
+            'generations': self.generations,
+            'generation_time': self.generation_time,
+        }
@@ -2,10 +2,36 @@
 """Context-free grammars and databases for
 generating general, randomized text.
 """
+import functools
 import re
 import random
 import os
 import logging
+import sys
+import threading
+
+from .alias import AliasTable
+from .cache import (INDEX_SUFFIX, cache_path, read_cache, read_index,
+                    write_cache, write_index)
+from .compiler import compile_entry, compile_template
+from .context import Context
+from .counting import Derivations
+from .dedup import Deduplicator
+from .lengths import LengthModel, pick
+from .rng import draw_source
+from .metrics import Metrics
+from .profiler import Profile
+from .optimize import constant_symbols, fold_nodes
+from .analysis import analyze, min_depths, reachable, reference_graph
+from .reload import StatReload
+from .lazy import scan
+from .wordlist import WordList, wordlist_hook
+from .store import Source, TextTable, concat
+from .trace import RecordingContext, ReplayContext, Trace
+from . import parallel, store
+
+
+logger = logging.getLogger(__name__)
 
 
 class ParseVariableError(Exception):
@@ -36,13 +62,45 @@ class Grammar(object):
     $varable:
       replace this $variable reference with its value, if set earlier. If $variable
       is not set, this reference will be replaced by empty string.
+      "Earlier" means earlier in the walk: text to the left, including the
+      expansion of every {symbol} to the left. A value set by a {symbol}
+      further right on the same line is not seen yet, so '$x {setx}'
+      expands $x to '' if {setx} is what sets $x.
 
     $variable="value":
       sets variable $variable to have value "value".
 
+    ^w entry
+      at the start of a definition line, gives the entry weight w (default 1)
+      when a random entry of its symbol is chosen. A symbol whose entries all
+      have weight 0 has no expansions and is left unexpanded, like an
+      undefined one.
+
     string $$variable
       this "lazy variable assignment" will assign $variable the value of the string.
       $$variable must come at the end of a line.
+
+    #wordlist symbol path
+      on a line of its own, defines symbol as the lines of the text file at
+      path, relative to the grammar file. The lines are used as they are,
+      without parsing, and the file is never read into memory. Lines
+      following the declaration belong to no symbol.
+
+    Setting budget to a nimrod.budget.Budget limits the text, symbol
+    expansions, depth and time of every expansion; parse(), interpret(),
+    generate_many() and iter_expand() also take a budget of their own for a
+    single call.
+
+    Every definition is compiled into an expansion tree when it is loaded, and
+    a string is expanded in a single left-to-right walk of its tree. The
+    definitions of a file are shared with every other grammar that loads the
+    same version of it, and are never modified.
+
+    The variables and random source of a generation live in a
+    nimrod.context.Context. parse() and interpret() use the grammar's own
+    default context unless they are given one; give every thread or task
+    its own context from new_context() to generate concurrently from one
+    loaded grammar.
     """
     symbol_hook = re.compile(r'(\{(.+?)\})')
     prob_hook = re.compile(r'(<([\.\d]+)\|(.+?)>)')
@@ -50,18 +108,102 @@ class Grammar(object):
     var_ref_hook = re.compile(r'\$(\w+)')
     var_assign_hook = re.compile(r'(\W|^)\$(\w+)="(.+)"')
     var_lazy_assign_hook = re.compile(r' \$\$(\w+)$')
+    weight_hook = re.compile(r'\^(\d*\.?\d+) ')
 
-    logging.basicConfig(filename='debug.log',
-                        filemode='w', level=logging.DEBUG)
+    # symbols nested deeper than this are left unexpanded
+    max_depth = 100
+    # replace references to symbols that always expand to the same text by
+    # that text when loading
+    fold_constants = True
+    # leave symbols that can never finish expanding unexpanded, instead of
+    # recursing into them up to max_depth
+    refuse_nonterminating = True
+    # number of distinct template strings whose expansion trees parse()
+    # keeps, least recently used first out
+    template_cache_size = 1024
+    # nimrod.budget.Budget that expansions are held to when a call does not
+    # give its own; None for no limits beyond max_depth
+    budget = None
 
-    def __init__(self):
+    def __init__(self, reload_policy=None):
         self.symbols = {}
+        self.compiled = {}
+        # alias tables of the symbols that have weighted entries
+        self.alias_tables = {}
+        # symbols whose compiled entries were rewritten or dropped by the
+        # load-time optimizations
+        self.folded = set()
         self.path = None
         self.mtime = None
-        self.variables = {}
         self.loaded_files = set()
+        # definitions contributed by each loaded file, in load order
+        self.sources = {}
+        self.mtimes = {}
+        # files imported by each loaded file
+        self.imports = {}
+        # word list -> the loaded file that reads it
+        self.wordlists = {}
+        # when loaded lazily, symbol -> files that define it and are still
+        # to be read, and file -> symbols it defines, until it is read
+        self.pending = {}
+        self.unread = {}
+        # text of the symbols folded into references to them
+        self.constants = {}
+        # expansion trees of the strings given to parse()
+        self.templates = None
+        self.set_template_cache_size(self.template_cache_size)
+        # generation counters, collected only after enable_stats()
+        self.metrics = None
+        # per-symbol time and text, collected only after enable_profiling()
+        self.profiling = None
+        # variables and random source used when no context is given
+        self.context = Context(self)
+        # derivation counts, computed on demand by count()
+        self.derivations = None
+        # output length distributions, computed on demand by sample()
+        self.length_model = None
+        # held while files are reloaded
+        self.reload_lock = threading.Lock()
+        self.reload_policy = None
+        self.set_reload_policy(reload_policy or StatReload())
+
+    @property
+    def variables(self):
+        """The variables of the default context."""
+        return self.context.variables
+
+    @variables.setter
+    def variables(self, variables):
+        self.context.variables = variables
 
-    def interpret(self, symbol, parse=True, depth=0):
+    @property
+    def rng(self):
+        """The random source of the default context."""
+        return self.context.rng
+
+    @rng.setter
+    def rng(self, rng):
+        self.context.rng = rng
+
+    def new_context(self, seed=None, rng=None, variables=None):
+        """Return a new nimrod.context.Context for generating from this
+        grammar, with its own variables and random source. Contexts are
+        cheap; the grammar itself is shared, not copied.
+
+        OPTIONAL ARGUMENTS:
+        seed: int (default None)
+          if given, the context draws from its own random.Random(seed)
+        rng: object with a random() method (default None)
+          random source to use instead; the random module if neither is given
+        variables: dict (default None)
+          initial variable values
+        """
+        if rng is None and seed is not None:
+            rng = random.Random(seed)
+        return Context(self, rng, variables)
+
+    def interpret(self, symbol, parse=True, depth=0, context=None,
+                  budget=None):
         """Return a random element of {symbol}.
 
         OPTIONAL ARGUMENTS:
@@ -69,88 +211,338 @@ class Grammar(object):
         parse: bool (default True)
           True: parses the random element of {symbol}
           False: return the literal random element of {symbol}
+        context: Context (default None)
+          variables and random source to use instead of the default context
+        budget: nimrod.budget.Budget (default None)
+          limits of this expansion, instead of the grammar's budget
         """
-        if symbol in self.symbols:
-            if parse:
-                return self.parse(random.choice(self.symbols[symbol]), depth=depth)
-            else:
-                return random.choice(self.symbols[symbol])
-        else:
-            return '{'+symbol+'}'
+        return (context or self.context).interpret(symbol, parse, depth,
+                                                   budget)
 
     def ref(self, var):
         """Return the stored value of $var."""
-        if var in self.variables:
-            return self.variables[var]
-        else:
-            return ''
+        return self.context.ref(var)
 
     def reset(self):
         """Clear all stored variable values."""
-        self.variables = {}
+        self.context.reset()
 
-    def parse(self, string, depth=0, **kwargs):
+    def parse(self, string, depth=0, context=None, budget=None, **kwargs):
         """Process a string according to nimrod syntax with the loaded dictionary
         of symbols.
+
+        The string is compiled into an expansion tree and walked once; the
+        trees of recently parsed strings are cached, see
+        set_template_cache_size(). Keyword arguments are substituted into the
+        expanded result with a single str.format, so the same template can be
+        parsed with different arguments without compiling it again. Variables
+        and random decisions come from context, or from the default context
+        if it is None. budget, if given, limits the expansion instead of the
+        grammar's budget.
+        """
+        return (context or self.context).parse(string, depth, budget,
+                                               **kwargs)
+
+    def compile(self, string):
+        """Return the expansion tree of a template string, from the template
+        cache if it was compiled recently.
+        """
+        return self.templates(string)
+
+    def _compile_template(self, string):
+        return fold_nodes(compile_template(string), self.constants)
+
+    def set_template_cache_size(self, capacity):
+        """Keep the expansion trees of the last capacity distinct strings
+        given to parse(), discarding those kept so far. A capacity of 0
+        disables the cache, None lets it grow without bound.
+        """
+        self.templates = functools.lru_cache(capacity)(self._compile_template)
+
+    def template_cache_info(self):
+        """Return the hits, misses, size and capacity of the template cache
+        as a dict. The counters restart whenever the cache is emptied.
+        """
+        info = self.templates.cache_info()
+        return {'hits': info.hits, 'misses': info.misses,
+                'size': info.currsize, 'capacity': info.maxsize}
+
+    def enable_stats(self):
+        """Start collecting generation statistics, discarding any collected
+        so far. Until this is called, no statistics are gathered and
+        generation pays nothing for them.
+        """
+        self.metrics = Metrics()
+        self._renew_context()
+
+    def disable_stats(self):
+        """Stop collecting generation statistics."""
+        if self.metrics is None:
+            return
+        self.metrics = None
+        self._renew_context()
+
+    def stats(self):
+        """Return the statistics collected since enable_stats() as a dict, or
+        None if statistics are disabled.
+
+        expansions: number of expansions of each symbol
+        depths: number of symbol expansions at each depth
+        gates_taken, gates_skipped: outcomes of <p|A|B> and <p|string>
+        reloads: number of files reloaded
+        generations, generation_time: number of generated strings and the
+          total seconds spent generating them
+        """
+        if self.metrics is None:
+            return None
+        return self.metrics.as_dict()
+
+    def enable_profiling(self):
+        """Start profiling the symbols of this grammar, discarding any
+        profile collected so far. See profile().
+        """
+        self.profiling = Profile()
+        self._renew_context()
+
+    def disable_profiling(self):
+        """Stop profiling the symbols of this grammar."""
+        if self.profiling is None:
+            return
+        self.profiling = None
+        self._renew_context()
+
+    def profile(self):
+        """Return the nimrod.profiler.Profile collected since
+        enable_profiling(), or None if profiling is disabled.
+
+        The profile holds the time, text and number of expansions of every
+        stack of symbols expanded in this process by parse(), interpret(),
+        generate_many() and generate_unique(), except expansions held to a
+        budget. Its collapsed() text can be fed to flame
+        graph tools, and report() lists the symbols that cost the most.
+        Profiling slows generation down several times over.
         """
-        # TODO: elaborate the docstring here.
+        return self.profiling
+
+    def _renew_context(self):
+        # contexts pick up the metrics when they are made
+        self.context = Context(self, self.context.rng, self.context.variables)
+
+    def generate_many(self, symbol, n, seed=None, budget=None):
+        """Return a list of n random expansions of {symbol}.
 
-        # make sure we have the most up-to-date definition file
+        The definition file is checked once for the whole batch, and random
+        decisions are drawn in blocks from a generator seeded with seed.
+        Variables carry over from one expansion to the next, as they would
+        when calling parse() in a loop. Each expansion is held to budget, or
+        the grammar's budget, on its own.
+        """
         self.check_file()
-        # cache initial state
-        initial_string = string
-        logging.info('depth {}: '.format(depth)+' '*depth+'{}'.format(string))
+        return Context(self, draw_source(seed),
+                       self.variables).generate(symbol, n, budget)
 
-        # catch variable assignments $variable=value
-        for match in self.var_assign_hook.finditer(string):
-            try:
-                self.variables[match.group(2)] = match.group(3)
-                logging.info('{} = {}'.format(match.group(2), match.group(3)))
-            except:
-                logging.debug('{} = {}'.format(match.group(2), match.group(3)))
-                raise ParseVariableError("Could not assign variable.")
-            string = string.replace(match.group(0), '', 1)
-
-        # catch lazy variable assignment "string $$var"
-        for match in self.var_lazy_assign_hook.finditer(string):
-            rest = string.replace(match.group(0), '', 1)
-            self.variables[match.group(1)] = rest
-            string = rest
-
-        # interpret either-or syntax <p|A|B>:
-        for match in self.either_hook.finditer(string):
-            if random.random() < float(match.group(2)):
-                string = string.replace(match.group(0), match.group(3), 1)
-            else:
-                string = string.replace(match.group(0), match.group(4), 1)
+    def generate_parallel(self, symbol, n, workers=None, seed=None):
+        """Return a list of n random expansions of {symbol}, generated by a
+        pool of worker processes.
 
-        # interpret probability syntax <p|string>:
-        for match in self.prob_hook.finditer(string):
-            if random.random() < float(match.group(2)):
-                string = string.replace(match.group(0), match.group(3), 1)
-            else:
-                string = string.replace(match.group(0), '', 1)
-
-        # interpret symbol replacement {symbol}
-        for match in self.symbol_hook.finditer(string):
-            string = string.replace(match.group(
-                1), self.interpret(match.group(2)), 1)
-
-        # interpret variable references $variable
-        for match in self.var_ref_hook.finditer(string):
-            string = string.replace(match.group(
-                0), self.ref(match.group(1)), 1)
-
-        # include optional variable replacement {keyword}
-        if kwargs:
-            string = string.format(**kwargs)
-
-        logging.info('depth {}: '.format(depth)+' '*depth+'{}'.format(string))
-        # recurse until we reach a stable orbit or depth limit is reached
-        if initial_string != string and depth < 100:
-            return self.parse(string, depth=depth + 1, **kwargs)
-        else:
-            return string
+        The loaded symbols are sent to each worker once. Each worker gets its
+        own random stream derived from seed and starts with no variables set,
+        so the result is reproducible for a given seed and number of workers.
+
+        OPTIONAL ARGUMENTS:
+        workers: int (default os.cpu_count())
+          number of worker processes
+        seed: int (default None)
+          seed for the per-worker random streams
+        """
+        self.check_file()
+        return parallel.generate_parallel(self, symbol, n,
+                                          workers=workers, seed=seed)
+
+    def generate_unique(self, symbol, n, dedup=None, seed=None,
+                        max_attempts=None):
+        """Return a list of up to n expansions of {symbol} that dedup has
+        not seen before.
+
+        Pass the same nimrod.dedup.Deduplicator to successive calls to avoid
+        repeats across a whole run; its duplicate_rate reports how many
+        generated strings were dropped. Generation stops after max_attempts
+        expansions, so fewer than n strings are returned when the symbol runs
+        out of new expansions.
+
+        OPTIONAL ARGUMENTS:
+        dedup: Deduplicator (default None)
+          if None, an exact deduplicator used for this call only
+        seed: int (default None)
+          seed for the random decisions
+        max_attempts: int (default 10 * n + 100)
+          most expansions to generate
+        """
+        self.check_file()
+        if dedup is None:
+            dedup = Deduplicator.exact()
+        if max_attempts is None:
+            max_attempts = 10 * n + 100
+        context = Context(self, draw_source(seed), self.variables)
+        results = []
+        attempts = 0
+        while len(results) < n and attempts < max_attempts:
+            batch = min(n - len(results), max_attempts - attempts)
+            attempts += batch
+            results.extend(dedup.unique(context.generate(symbol, batch)))
+        return results
+
+    def record(self, symbol, seed=None):
+        """Return a random expansion of {symbol} along with the
+        nimrod.trace.Trace of the choices that produced it. render() turns
+        the trace back into the same text, as long as the grammar has not
+        changed.
+
+        The expansion starts with no variables set. Random decisions come
+        from random.Random(seed) if seed is given, otherwise from the default
+        context.
+        """
+        return self.record_many(symbol, 1, seed)[0]
+
+    def record_many(self, symbol, n, seed=None):
+        """Return a list of n (text, trace) pairs, as record() would."""
+        self.check_file()
+        rng = self.rng if seed is None else random.Random(seed)
+        context = RecordingContext(self, rng)
+        results = []
+        for _ in range(n):
+            context.reset()
+            start = len(context.choices)
+            text = context.generate(symbol, 1)[0]
+            results.append((text, Trace(symbol, context.choices[start:])))
+        return results
+
+    def render(self, trace):
+        """Return the text the choices in trace produce.
+
+        Raises ValueError if the trace cannot have been recorded from this
+        grammar, because it has too few or too many choices or chooses an
+        entry a symbol does not have.
+        """
+        context = ReplayContext(self, trace.choices)
+        text = context.generate(trace.symbol, 1)[0]
+        if context.position != len(trace.choices):
+            raise ValueError('trace has unused choices: it does not match '
+                             'the grammar')
+        return text
+
+    def count(self, symbol):
+        """Return the number of distinct derivations of {symbol}.
+
+        A derivation is one choice of entry for every symbol expanded and of
+        branch for every <p|A|B> or <p|string>, which always count as two
+        branches. Raises ValueError if {symbol} can expand into itself.
+        """
+        return self._derivations().symbol_count(symbol)
+
+    def enumerate(self, symbol):
+        """Yield every derivation of {symbol}, numbered as in nth(), without
+        building them all in memory.
+        """
+        derivations = self._derivations()
+        for index in range(derivations.symbol_count(symbol)):
+            yield self._render(derivations, symbol, index)
+
+    def nth(self, symbol, index):
+        """Return derivation number index of {symbol}, for
+        0 <= index < count(symbol).
+
+        Derivations are numbered in a stable order: entries in definition
+        order, taken gate branches first, and the earlier parts of an entry
+        varying slowest. Variable references use the first derivation of
+        their value.
+        """
+        derivations = self._derivations()
+        if not 0 <= index < derivations.symbol_count(symbol):
+            raise IndexError('derivation index out of range')
+        return self._render(derivations, symbol, index)
+
+    def _derivations(self):
+        self.load_pending()
+        if self.derivations is None:
+            self.derivations = Derivations(self.compiled, self.max_depth)
+        return self.derivations
+
+    def lengths(self, symbol, max_len):
+        """Return the probability of each length, in characters, of an
+        expansion of {symbol}, as a dict of length -> probability for lengths
+        up to max_len. $variable references count as empty.
+        """
+        return dict((length, p) for length, p
+                    in self._length_model(max_len).symbol(symbol).items()
+                    if length <= max_len)
+
+    def sample(self, symbol, min_len, max_len, context=None, attempts=100):
+        """Return a random expansion of {symbol} between min_len and max_len
+        characters long, inclusive.
+
+        Instead of generating expansions until one fits, the length of the
+        result is drawn from the lengths {symbol} can have, and every random
+        choice is made knowing how much text is still to come, see
+        nimrod.lengths. Expansions are as likely as interpret() would make
+        them, among those of a fitting length. Since variables are not taken
+        into account, an expansion that uses them may not fit; it is then
+        drawn again, up to attempts times.
+
+        Raises ValueError if no expansion of {symbol} fits.
+        """
+        self.check_file()
+        context = context or self.context
+        model = self._length_model(max_len)
+        fitting = [(length, p) for length, p in model.symbol(symbol).items()
+                   if min_len <= length <= max_len]
+        if not fitting:
+            raise ValueError('no expansion of {{{}}} is between {} and {} '
+                             'characters long'.format(symbol, min_len,
+                                                      max_len))
+        for _ in range(attempts):
+            length = fitting[pick([p for _, p in fitting],
+                                  context.rng.random())][0]
+            out = []
+            model.render_symbol(symbol, length, context, out)
+            result = ''.join(out)
+            if min_len <= len(result) <= max_len:
+                return result
+        raise ValueError('no expansion of {{{}}} between {} and {} '
+                         'characters long was found in {} attempts'.format(
+                             symbol, min_len, max_len, attempts))
+
+    def _length_model(self, max_len):
+        self.load_pending()
+        model = self.length_model
+        if model is None or model.limit < max_len:
+            model = LengthModel(self.compiled, self.alias_tables, max_len,
+                                self.max_depth)
+            self.length_model = model
+        return model
+
+    def _render(self, derivations, symbol, index):
+        out = []
+        derivations.render_symbol(symbol, index, out, {})
+        return ''.join(out)
+
+    def iter_expand(self, symbol, context=None, budget=None):
+        """Yield a random expansion of {symbol} fragment by fragment.
+
+        The expansion is walked depth-first, left to right, and each piece of
+        text is yielded as soon as it is produced. Joining the fragments gives
+        what interpret() would return with the same random state. When its
+        budget runs out, the expansion stops, or raises
+        nimrod.budget.BudgetExceeded under the 'raise' policy.
+        """
+        self.check_file()
+        return (context or self.context).iter_expand(symbol, budget)
+
+    def stream(self, symbol, file, context=None, budget=None):
+        """Write a random expansion of {symbol} to the file-like object file
+        as it is produced.
+        """
+        file.writelines(self.iter_expand(symbol, context, budget))
 
     def default(self):
         """Return the default string, which is optionally defined in a dictionary
@@ -160,38 +552,519 @@ class Grammar(object):
         print(self.interpret('default'))
 
     def check_file(self):
-        """Check to see if the file has changed.
-        If it has, reload the file.
+        """Give the reload policy a chance to reload files that changed."""
+        self.reload_policy.check(self)
+
+    def set_reload_policy(self, policy):
+        """Replace the policy that decides when changed files are reloaded.
+        See nimrod.reload for the available policies.
+        """
+        if self.reload_policy is not None:
+            self.reload_policy.detach()
+        self.reload_policy = policy
+        policy.attach(self)
+
+    def changed_files(self):
+        """Return the loaded files whose modification time, or that of a
+        word list they read, has changed.
+        """
+        changed = []
+        for path, mtime in list(self.mtimes.items()):
+            try:
+                if os.stat(path).st_mtime == mtime:
+                    continue
+            except OSError:
+                continue
+            path = self.wordlists.get(path, path)
+            if path not in changed:
+                changed.append(path)
+        return changed
+
+    def reload_changed(self):
+        """Reload the symbols of every loaded file that has changed, leaving
+        symbols from other files untouched. Return the reloaded paths.
         """
-        statbuf = os.stat(self.path)
-        if self.mtime != statbuf.st_mtime:
-            self.load(self.path)
+        # a reload already under way in another thread will pick up the
+        # same changes
+        if not self.reload_lock.acquire(False):
+            return []
+        try:
+            changed = self.changed_files()
+            for path in changed:
+                logger.info('reloading %s', path)
+                self._reload_file(path)
+            if changed:
+                self._optimize()
+        finally:
+            self.reload_lock.release()
+        if self.metrics is not None:
+            self.metrics.reloads += len(changed)
+        return changed
 
-    def load(self, path, append=False):
-        """Load the grammar definition at path.
+    def analyze(self, roots=('default',)):
+        """Analyze the references between the loaded symbols and return a
+        nimrod.analysis.Analysis with:
+
+        unresolved: references to symbols that are not defined
+        unreachable: symbols that cannot be reached from roots
+        cycles: groups of symbols that can expand into each other
+        nonterminating: symbols that can never finish expanding; these are
+          left unexpanded when refuse_nonterminating is set
+        min_depth, max_depth: fewest and most nested symbol levels of an
+          expansion of each symbol, None if there is no such bound
+        """
+        self.load_pending()
+        return analyze(self._unoptimized(), roots)
+
+    def prune(self, roots=('default',)):
+        """Forget every symbol that cannot be reached from roots, and return
+        the set of forgotten symbols. Nothing is pruned if none of roots is
+        defined. Pruned symbols are read again if their file is reloaded.
+        """
+        self.load_pending()
+        with self.reload_lock:
+            graph = reference_graph(self._unoptimized())
+            if not any(root in graph for root in roots):
+                return set()
+            pruned = set(graph) - reachable(graph, roots)
+            # sources are shared, so replace them instead of removing keys
+            for path, source in self.sources.items():
+                if pruned.intersection(source):
+                    kept = Source((key, value) for key, value in source.items()
+                                  if key not in pruned)
+                    kept.wordlists = getattr(source, 'wordlists', {})
+                    self.sources[path] = kept
+            for key in pruned:
+                self.symbols.pop(key, None)
+                self.compiled.pop(key, None)
+                self.alias_tables.pop(key, None)
+            self._optimize()
+            return pruned
+
+    def load(self, path, append=False, cache=None, lazy=False):
+        """Load the grammar definition at path, along with every file it
+        imports with #import.
 
         OPTIONAL ARGUMENTS:
         append: bool (default False)
           if False, clear all symbols first.
+        cache: bool or str (default None)
+          if True, reuse the compiled definitions stored next to the file
+          by an earlier load, as long as none of the files changed since, and
+          store them there otherwise. If a directory name, keep the cache
+          there instead.
+        lazy: bool (default False)
+          if True, only find out which symbols each file defines, and read
+          a file the first time one of its symbols is expanded. With cache,
+          what each file defines is cached instead of its definitions.
         """
-        if len(path) < 4 or path[-4] != '.txt':
-            path = path + '.txt'
+        # a reload policy's thread must not reload files while they are
+        # being replaced
+        with self.reload_lock:
+            self._load(path, append, cache, lazy)
+
+    def _load(self, path, append, cache, lazy):
+        path = self._resolve(path)
         if not append:
             self.loaded_files = set()
             self.symbols = {}
+            self.compiled = {}
+            self.alias_tables = {}
+            self.folded = set()
+            self.sources = {}
+            self.mtimes = {}
+            self.imports = {}
+            self.wordlists = {}
+            self.pending = {}
+            self.unread = {}
         self.path = path
+
+        if lazy:
+            self._load_index(path, cache)
+            return
+
+        cache_file = None
+        if cache:
+            cache_file = cache_path(path, None if cache is True else cache)
+            cached = read_cache(cache_file)
+            if cached is not None and any(
+                    self._wordlists_changed(source)
+                    for source_path, stamp, source, imports in cached):
+                # a word list changed since the cache was written
+                cached = None
+            if cached is not None:
+                for source_path, stamp, source, imports in cached:
+                    if source_path not in self.loaded_files:
+                        store.share(source_path, type(self), stamp, source,
+                                    imports)
+                        self.loaded_files.add(source_path)
+                        self.mtimes[source_path] = stamp[1]
+                        self.imports[source_path] = imports
+                        self._add_source(source_path, source)
+                self.mtime = self.mtimes[path]
+                self._optimize()
+                return
+
+        self._load_file(path)
+        self.mtime = self.mtimes[path]
+        self._optimize()
+
+        if cache_file is not None:
+            # every file path imports, including those an earlier load with
+            # append already read, so that the cache is complete on its own
+            files = self._import_closure(path)
+            write_cache(cache_file, [(p, self.mtimes[p], source,
+                                      self.imports[p])
+                                     for p, source in self.sources.items()
+                                     if p in files])
+
+    def _import_closure(self, path):
+        """Return the set of loaded files path imports, directly or not,
+        and path itself.
+        """
+        files = set()
+        pending = [path]
+        while pending:
+            file_path = pending.pop()
+            if file_path in files:
+                continue
+            files.add(file_path)
+            pending.extend(self._resolve(imp, relative_to=file_path)
+                           for imp in self.imports.get(file_path, ()))
+        return files
+
+    def _resolve(self, path, relative_to=None):
+        if relative_to is not None:
+            path = os.path.join(os.path.dirname(relative_to), path)
+        if not path.endswith('.txt'):
+            path = path + '.txt'
+        return path
+
+    def _load_index(self, path, cache):
+        index_file = None
+        files = None
+        if cache:
+            index_file = cache_path(path, None if cache is True else cache,
+                                    INDEX_SUFFIX)
+            files = read_index(index_file)
+        if files is None:
+            files = scan(path, self._resolve)
+            if index_file is not None:
+                write_index(index_file, files)
+        for file_path, keys, imports in files:
+            if file_path in self.loaded_files:
+                continue
+            self.loaded_files.add(file_path)
+            # hold the file's place, so symbols defined in several files
+            # keep their entries in load order
+            self.sources[file_path] = {}
+            self.unread[file_path] = keys
+            for key in keys:
+                self.pending.setdefault(key, []).append(file_path)
+        self.mtime = self.mtimes.get(path)
+        self._optimize()
+
+    def load_symbol(self, symbol):
+        """Read every file that defines symbol and has not been read yet by
+        a lazy load(), and return the compiled entries of symbol, or None if
+        it is not defined.
+        """
+        with self.reload_lock:
+            paths = self.pending.get(symbol)
+            if paths:
+                for path in list(paths):
+                    self._load_pending_file(path)
+                self._optimize()
+        return self.compiled.get(symbol)
+
+    def load_pending(self):
+        """Read every file a lazy load() has not read yet."""
+        with self.reload_lock:
+            if not self.unread:
+                return
+            for path in list(self.sources):
+                if path in self.unread:
+                    self._load_pending_file(path)
+            self._optimize()
+
+    def include(self, *others):
+        """Add the definitions of every file loaded by the grammars others,
+        as if this grammar had imported them. The definitions are shared,
+        not read again or copied; a file loaded by several grammars is added
+        once.
+        """
+        for other in others:
+            other.load_pending()
+        with self.reload_lock:
+            for other in others:
+                for path, source in list(other.sources.items()):
+                    if path in self.loaded_files:
+                        continue
+                    self.loaded_files.add(path)
+                    self.mtimes[path] = other.mtimes[path]
+                    self.imports[path] = other.imports[path]
+                    self._add_source(path, source)
+            self._optimize()
+
+    def _load_pending_file(self, path):
+        source, imports = self._shared_source(path)
+        for key in self.unread.pop(path):
+            paths = self.pending[key]
+            paths.remove(path)
+            if not paths:
+                del self.pending[key]
+        self.sources[path] = source
+        self._track_wordlists(path, source)
+        for key in source:
+            self._merge_symbol(key)
+            self._build_alias_table(key)
+        if path == self.path:
+            self.mtime = self.mtimes[path]
+
+    def _load_file(self, path):
+        self.loaded_files.add(path)
+        source, imports = self._shared_source(path)
+        self._add_source(path, source)
+        self._load_imports(path, imports)
+
+    def _shared_source(self, path):
+        """Return the compiled definitions and imports of the file at path,
+        reading it only if no grammar of this class has read its current
+        version.
+        """
+        stamp, source, imports = store.shared_source(path, type(self),
+                                                     self._build_source)
+        if self._wordlists_changed(source):
+            # the file is unchanged, but a word list it reads is not
+            source, imports = self._build_source(path)
+            store.share(path, type(self), stamp, source, imports)
+        self.mtimes[path] = stamp[1]
+        self.imports[path] = imports
+        return source, imports
+
+    def _wordlists_changed(self, source):
+        for path, mtime in getattr(source, 'wordlists', {}).items():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return True
+            except OSError:
+                continue
+        return False
+
+    def _track_wordlists(self, path, source):
+        """Watch the word lists read by the loaded file at path."""
+        for wordlist_path, declared_by in list(self.wordlists.items()):
+            if declared_by == path:
+                del self.wordlists[wordlist_path]
+                self.mtimes.pop(wordlist_path, None)
+        for wordlist_path, mtime in getattr(source, 'wordlists', {}).items():
+            self.wordlists[wordlist_path] = path
+            self.mtimes[wordlist_path] = mtime
+
+    def _build_source(self, path):
+        definitions, imports = self._read_file(path)
+        return self._compile_definitions(definitions), tuple(imports)
+
+    def _add_source(self, path, source):
+        self.sources[path] = source
+        self._track_wordlists(path, source)
+        for key, (lines, entries, weights) in source.items():
+            if key in self.symbols:
+                self._merge_symbol(key)
+            else:
+                # share the file's definitions as they are
+                self.symbols[key] = lines
+                self.compiled[key] = entries
+            if weights is not None or key in self.alias_tables:
+                self._build_alias_table(key)
+
+    def _load_imports(self, path, imports):
+        for imp in imports:
+            new_path = self._resolve(imp, relative_to=path)
+            if new_path not in self.loaded_files:
+                self._load_file(new_path)
+
+    def _reload_file(self, path):
+        new_source, imports = self._shared_source(path)
+        old_source = self.sources[path]
+        self.sources[path] = new_source
+        self._track_wordlists(path, new_source)
+        # rebuild only the symbols whose definitions in this file changed
+        for key in set(old_source) | set(new_source):
+            old = old_source.get(key, (None, None, None))
+            new = new_source.get(key, (None, None, None))
+            if old[0] == new[0] and old[2] == new[2]:
+                continue
+            self._merge_symbol(key)
+            self._build_alias_table(key)
+        if path == self.path:
+            self.mtime = self.mtimes[path]
+        self._load_imports(path, imports)
+
+    def _merge_symbol(self, key):
+        """Rebuild the lines and compiled entries of key from every source.
+        A symbol that files still to be read also define is left out until
+        they are read.
+        """
+        lines, entries = self._merged_entries(key)
+        if lines and key not in self.pending:
+            self.symbols[key] = lines
+            self.compiled[key] = entries
+        else:
+            self.symbols.pop(key, None)
+            self.compiled.pop(key, None)
+
+    def _merged_entries(self, key):
+        lines = []
+        entries = []
+        for source in self.sources.values():
+            if key in source:
+                lines.append(source[key][0])
+                entries.append(source[key][1])
+        if not lines:
+            return (), ()
+        return concat(lines), concat(entries)
+
+    def _unoptimized(self):
+        """Return the compiled entries of every symbol as loaded, before
+        the load-time optimizations.
+        """
+        compiled = dict(self.compiled)
+        for key in self.folded:
+            lines, entries = self._merged_entries(key)
+            if entries:
+                compiled[key] = entries
+        return compiled
+
+    def _optimize(self):
+        """Apply the load-time optimizations to the compiled entries.
+
+        Symbols that can never finish expanding are dropped from
+        self.compiled, so references to them stay unexpanded. Every
+        reference to a constant symbol, one that always expands to the same
+        text, is replaced by that text.
+        """
+        self.derivations = None
+        self.length_model = None
+        # cached templates may refer to symbols that changed
+        self.constants = {}
+        self.templates.cache_clear()
+        # start over from the entries as they were compiled
+        for key in self.folded:
+            self._merge_symbol(key)
+        self.folded = set()
+
+        if self.refuse_nonterminating:
+            for key, depth in min_depths(self.compiled).items():
+                if depth == float('inf'):
+                    del self.compiled[key]
+                    self.folded.add(key)
+
+        if not self.fold_constants:
+            return
+        constants = constant_symbols(self.compiled, self.pending)
+        if not constants:
+            return
+        self.constants = constants
+        # entries are shared between symbols, so fold each one only once
+        folded_entries = {}
+        for key, entries in self.compiled.items():
+            if isinstance(entries, TextTable):
+                # plain text refers to no symbols
+                continue
+            folded = []
+            for entry in entries:
+                new_entry = folded_entries.get(id(entry))
+                if new_entry is None:
+                    new_entry = fold_nodes(entry, constants)
+                    folded_entries[id(entry)] = new_entry
+                folded.append(new_entry)
+            if any(new is not old for new, old in zip(folded, entries)):
+                self.compiled[key] = tuple(folded)
+                self.folded.add(key)
+
+    def _build_alias_table(self, key):
+        """Rebuild the alias table of key from the weights in every source,
+        or drop it if none of its entries are weighted. A symbol whose
+        entries all weigh 0 is dropped with it.
+        """
+        weights = []
+        weighted = False
+        for source in self.sources.values():
+            if key in source:
+                lines, entries, source_weights = source[key]
+                if source_weights is None:
+                    weights.extend([1.0] * len(lines))
+                else:
+                    weights.extend(source_weights)
+                    weighted = True
+        if weighted and sum(weights) > 0:
+            self.alias_tables[key] = AliasTable(weights)
+            return
+        self.alias_tables.pop(key, None)
+        if weighted and key in self.symbols:
+            # no entry can ever be chosen
+            logger.warning('every entry of {%s} has weight 0', key)
+            del self.symbols[key]
+            self.compiled.pop(key, None)
+
+    def _compile_definitions(self, definitions):
+        """Compile a dict of definition lines by symbol into a dict of
+        (lines, entries, weights) by symbol, where weights is None if no
+        line of the symbol has a weight. Identical nodes are shared within
+        the file; the memo that finds them is dropped once it is compiled.
+        """
+        memo = {}
+        source = Source()
+        for key, items in definitions.items():
+            for item in items:
+                if isinstance(item, WordList):
+                    source.wordlists[item.path] = item.stamp[1]
+            if len(items) == 1 and isinstance(items[0], WordList):
+                if len(items[0]):
+                    source[key] = (items[0], items[0], None)
+                continue
+            lines = []
+            entries = []
+            weights = []
+            weighted = False
+            for item in items:
+                if isinstance(item, WordList):
+                    lines.extend(item)
+                    entries.extend(item)
+                    weights.extend([1.0] * len(item))
+                    continue
+                weight = 1.0
+                match = self.weight_hook.match(item)
+                if match:
+                    weighted = True
+                    weight = float(match.group(1))
+                    item = item[match.end():]
+                lines.append(item)
+                entries.append(compile_entry(item, memo))
+                weights.append(weight)
+            table = TextTable(lines)
+            if all(entry.__class__ is str for entry in entries):
+                # plain text entries are read straight from the lines
+                entries = table
+            else:
+                entries = tuple(entries)
+            source[key] = (table, entries,
+                           tuple(weights) if weighted else None)
+        return source
+
+    def _read_file(self, path):
+        """Return the definitions in the file at path, as a dict of lists of
+        lines and WordLists by symbol, and the list of files it imports.
+        """
+        definitions = {}
         imports = []
         defmatch = re.compile(r'#')
         impmatch = re.compile(r'#import ([\w\.]+)')
 
-        # store the file modification time
-        statbuf = os.stat(self.path)
-        self.mtime = statbuf.st_mtime
-
         # parse the definition file
         current_key = ''
         with open(path, 'r') as f:
-            self.loaded_files.add(path)
             for line in f:
                 line = line.rstrip()
                 if not line:
@@ -199,19 +1072,18 @@ class Grammar(object):
                 match = defmatch.search(line)
                 if match:
                     import_match = impmatch.search(line)
+                    wordlist_match = wordlist_hook.search(line)
                     if import_match:
                         imports.append(import_match.group(1))
+                    elif wordlist_match:
+                        key = sys.intern(wordlist_match.group(1))
+                        wordlist_path = os.path.join(os.path.dirname(path),
+                                                     wordlist_match.group(2))
+                        definitions.setdefault(key, []).append(
+                            WordList(wordlist_path))
+                        current_key = None
                     else:
-                        current_key = line[1:]
-                if not match:
-                    items = self.symbols.get(current_key, [])
-                    items.append(line)
-                    self.symbols[current_key] = items
-
-        for imp in imports:
-            # TODO: test if circular imports are avoided
-            if imp not in self.loaded_files:
-                self.loaded_files.add(imp)
-                working_dir = os.path.dirname(path)
-                new_path = os.path.join(working_dir, imp)
-                self.load(new_path, append=True)
+                        current_key = sys.intern(line[1:])
+                elif current_key is not None:
+                    definitions.setdefault(current_key, []).append(line)
+        return definitions, imports
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Load-time optimizations of compiled grammars."""
+from .compiler import EitherOr, Literal, ProbGate, SymbolRef
+
+
+def constant_symbols(compiled, pending=()):
+    """Return a dict of the symbols whose expansion is always the same
+    string, mapped to that string.
+
+    A symbol is constant if it has a single entry made only of plain
+    text and references to other constant symbols. References to undefined
+    symbols expand to themselves and count as plain text, unless they are in
+    pending, symbols whose definitions have not been read yet. Symbols on a
+    cycle are never constant.
+    """
+    constants = {}
+    # symbol -> whether it is constant; None while it is being visited
+    known = {}
+
+    def visit(symbol):
+        if symbol in known:
+            # a symbol met again while being visited is on a cycle
+            return bool(known[symbol])
+        known[symbol] = None
+        known[symbol] = constant = expand(symbol)
+        return constant
+
+    def expand(symbol):
+        entries = compiled[symbol]
+        # a symbol with repeated entries is not folded: each one is a
+        # derivation of its own, see Grammar.count()
+        if len(entries) != 1:
+            return False
+        first = entries[0]
+        if first.__class__ is str:
+            constants[symbol] = first
+            return True
+        parts = []
+        for node in first:
+            if node.__class__ is Literal:
+                parts.append(node.text)
+            elif node.__class__ is SymbolRef:
+                if node.name in pending:
+                    return False
+                if node.name not in compiled:
+                    parts.append('{' + node.name + '}')
+                elif visit(node.name):
+                    parts.append(constants[node.name])
+                else:
+                    return False
+            else:
+                return False
+        constants[symbol] = ''.join(parts)
+        return True
+
+    for symbol in compiled:
+        visit(symbol)
+    return constants
+
+
+def fold_nodes(nodes, constants):
+    """Return nodes with references to constant symbols replaced by their
+    text and adjacent text merged, or nodes itself if nothing changed.
+    """
+    if nodes.__class__ is str:
+        return nodes
+    folded = []
+    changed = False
+    for node in nodes:
+        if node.__class__ is SymbolRef and node.name in constants:
+            node = Literal(constants[node.name])
+            changed = True
+        elif node.__class__ is ProbGate:
+            body = fold_nodes(node.body, constants)
+            if body is not node.body:
+                node = ProbGate(node.p, body)
+                changed = True
+        elif node.__class__ is EitherOr:
+            first = fold_nodes(node.first, constants)
+            second = fold_nodes(node.second, constants)
+            if first is not node.first or second is not node.second:
+                node = EitherOr(node.p, first, second)
+                changed = True
+        if (node.__class__ is Literal and folded
+                and folded[-1].__class__ is Literal):
+            node = Literal(folded.pop().text + node.text)
+            changed = True
+        folded.append(node)
+    if not changed:
+        return nodes
+    return tuple(folded)
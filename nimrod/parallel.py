@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Generation across a pool of worker processes.
+
+Each worker receives the loaded symbol table once, when the pool starts, and
+rebuilds a private grammar from it. Work is split into one chunk per worker
+and every chunk gets its own seed derived from the caller's seed, so the
+combined output only depends on the seed and the number of workers.
+"""
+import collections
+import concurrent.futures
+import os
+
+from .context import Context
+from .rng import draw_source, spawn_seeds
+
+
+# the grammar rebuilt inside each worker process
+_worker_grammar = None
+
+
+def _init_worker(cls, symbols, compiled, alias_tables, budget):
+    global _worker_grammar
+    _worker_grammar = cls()
+    _worker_grammar.symbols = symbols
+    _worker_grammar.compiled = compiled
+    _worker_grammar.alias_tables = alias_tables
+    _worker_grammar.budget = budget
+
+
+def _generate_chunk(symbol, n, seed):
+    return generate_chunk(_worker_grammar, symbol, n, seed)
+
+
+def generate_chunk(grammar, symbol, n, seed):
+    """Expand symbol n times with fresh variables and a seeded random
+    source.
+    """
+    return Context(grammar, draw_source(seed)).generate(symbol, n)
+
+
+def chunk_sizes(n, chunks):
+    """Split n into chunks sizes that differ by at most one."""
+    size, extra = divmod(n, chunks)
+    return [size + 1 if i < extra else size for i in range(chunks)]
+
+
+def generate_parallel(grammar, symbol, n, workers=None, seed=None):
+    """Return n expansions of symbol, generated by a pool of processes."""
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, n))
+    sizes = chunk_sizes(n, workers)
+    seeds = spawn_seeds(seed, workers)
+
+    if workers == 1:
+        return generate_chunk(grammar, symbol, sizes[0], seeds[0])
+
+    grammar.load_pending()
+    initargs = (type(grammar), grammar.symbols, grammar.compiled,
+                grammar.alias_tables, grammar.budget)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            initargs=initargs) as pool:
+        futures = [pool.submit(_generate_chunk, symbol, size, chunk_seed)
+                   for size, chunk_seed in zip(sizes, seeds)]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+    return results
+
+
+def iter_parallel(grammar, symbol, n, workers=None, seed=None,
+                  batch_size=10000):
+    """Yield lists of expansions of symbol, n in all, in batches of
+    batch_size generated by a pool of processes.
+
+    Batches are yielded in order and only a few per worker are in flight at
+    a time, so memory does not grow with n. Every batch gets its own seed
+    derived from seed, so the output depends only on the seed and the batch
+    size.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    full, rest = divmod(n, batch_size)
+    sizes = [batch_size] * full + ([rest] if rest else [])
+    seeds = spawn_seeds(seed, len(sizes))
+
+    grammar.load_pending()
+    initargs = (type(grammar), grammar.symbols, grammar.compiled,
+                grammar.alias_tables, grammar.budget)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            initargs=initargs) as pool:
+        pending = collections.deque()
+        for size, batch_seed in zip(sizes, seeds):
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+            pending.append(pool.submit(_generate_chunk, symbol, size,
+                                       batch_seed))
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Time and text attributed to the symbols of a grammar.
+
+While profiling is enabled, every expansion of a symbol is timed and the
+text it produces is counted, keyed by the stack of symbols being expanded,
+such as 'default;scene;character;name'. Each stack is charged only for its
+own work; the time and text of the symbols it refers to go to their own,
+longer stacks. That is the collapsed-stack format read by flame graph tools
+such as flamegraph.pl, speedscope and inferno.
+"""
+import collections
+
+WEIGHTS = ('time', 'chars', 'calls')
+
+
+class Profile(object):
+    """Per-stack counters of a profiled grammar.
+
+    time: stack -> seconds spent in the stack itself
+    chars: stack -> characters of text produced by the stack itself
+    calls: stack -> number of times the stack was expanded
+    """
+
+    def __init__(self):
+        self.time = collections.Counter()
+        self.chars = collections.Counter()
+        self.calls = collections.Counter()
+
+    def _weights(self, weight):
+        if weight not in WEIGHTS:
+            raise ValueError('weight must be one of {}'.format(
+                ', '.join(WEIGHTS)))
+        return getattr(self, weight)
+
+    def collapsed(self, weight='time'):
+        """Return the profile as collapsed-stack text, one 'stack value'
+        line per stack. Time is given in whole microseconds.
+        """
+        weights = self._weights(weight)
+        scale = 1e6 if weight == 'time' else 1
+        lines = []
+        for stack in sorted(weights):
+            value = int(round(weights[stack] * scale))
+            if value > 0:
+                lines.append('{} {}\n'.format(stack, value))
+        return ''.join(lines)
+
+    def symbols(self):
+        """Return a dict of symbol -> (seconds, chars, calls), the work of
+        every stack added up by the symbol at its top.
+        """
+        totals = {}
+        for stack, calls in self.calls.items():
+            symbol = stack.rpartition(';')[2]
+            seconds, chars, count = totals.get(symbol, (0.0, 0, 0))
+            totals[symbol] = (seconds + self.time[stack],
+                              chars + self.chars[stack], count + calls)
+        return totals
+
+    def top(self, n=10, weight='time'):
+        """Return the n symbols with the most work of their own, as a list of
+        (symbol, seconds, chars, calls) sorted by weight.
+        """
+        self._weights(weight)
+        index = WEIGHTS.index(weight) + 1
+        rows = [(symbol,) + totals
+                for symbol, totals in self.symbols().items()]
+        rows.sort(key=lambda row: (-row[index], row[0]))
+        return rows[:n]
+
+    def report(self, n=10, weight='time'):
+        """Return top(n, weight) as a table of text."""
+        lines = ['{:<30} {:>10} {:>7} {:>10} {:>10}\n'.format(
+            'symbol', 'ms', '%time', 'chars', 'calls')]
+        total = sum(self.time.values()) or 1.0
+        for symbol, seconds, chars, calls in self.top(n, weight):
+            lines.append('{:<30} {:>10.3f} {:>7.1%} {:>10} {:>10}\n'.format(
+                symbol, seconds * 1e3, seconds / total, chars, calls))
+        return ''.join(lines)
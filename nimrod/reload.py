@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Policies for reloading grammar files that change on disk.
+
+A grammar calls its policy's check() before generating. Each policy decides
+when to look for modified files. Only the files that changed are reloaded,
+through Grammar.reload_changed().
+"""
+import os
+import threading
+import time
+import weakref
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+class NoReload(object):
+    """Never look for changes: generation costs no system calls."""
+
+    def attach(self, grammar):
+        """Start watching grammar."""
+
+    def detach(self):
+        """Stop watching."""
+
+    def check(self, grammar):
+        """Called by the grammar before generating."""
+
+
+class StatReload(NoReload):
+    """Stat every loaded file when the grammar is used, at most once every
+    interval seconds. An interval of 0 checks on every call.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.last_check = None
+
+    def check(self, grammar):
+        now = time.time()
+        if (self.last_check is not None
+                and now - self.last_check < self.interval):
+            return
+        self.last_check = now
+        grammar.reload_changed()
+
+
+class PollingReload(NoReload):
+    """Stat every loaded file from a background thread every interval
+    seconds, so generation itself never waits on the file system.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def attach(self, grammar):
+        self.stopped.clear()
+        # the thread must not keep the grammar alive
+        self.thread = threading.Thread(target=self._run,
+                                       args=(weakref.ref(grammar),))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def detach(self):
+        self.stopped.set()
+        self.thread = None
+
+    def _run(self, grammar_ref):
+        while not self.stopped.wait(self.interval):
+            grammar = grammar_ref()
+            if grammar is None:
+                return
+            grammar.reload_changed()
+            del grammar
+
+
+class InotifyReload(PollingReload):
+    """Reload as soon as the kernel reports a write to the directory of a
+    loaded file. Falls back to polling every interval seconds when the
+    inotify_simple package is not installed.
+    """
+
+    def _run(self, grammar_ref):
+        if inotify_simple is None:
+            return super(InotifyReload, self)._run(grammar_ref)
+        flags = inotify_simple.flags
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+        inotify = inotify_simple.INotify()
+        watched = set()
+        try:
+            while not self.stopped.is_set():
+                grammar = grammar_ref()
+                if grammar is None:
+                    return
+                directories = set(os.path.dirname(path) or '.'
+                                  for path in grammar.mtimes)
+                del grammar
+                for directory in directories - watched:
+                    inotify.add_watch(directory, mask)
+                    watched.add(directory)
+                if inotify.read(timeout=int(self.interval * 1000)):
+                    grammar = grammar_ref()
+                    if grammar is None:
+                        return
+                    grammar.reload_changed()
+                    del grammar
+        finally:
+            inotify.close()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Random sources for the expansion engine.
+
+The engine only ever asks its source for uniform floats through a
+``random()`` method, so the module-level ``random``, a ``random.Random``
+instance or a block-buffered NumPy generator can all be used.
+"""
+import functools
+import itertools
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# number of floats drawn from NumPy per block
+BLOCK_SIZE = 4096
+
+
+class BlockDraws(object):
+    """Uniform floats drawn from a NumPy generator in blocks.
+
+    Every block is a single vectorized call; ``random()`` hands the floats out
+    one at a time without going back into NumPy.
+    """
+
+    def __init__(self, seed=None, block_size=BLOCK_SIZE):
+        self.generator = numpy.random.default_rng(seed)
+        self.block_size = block_size
+        draws = itertools.chain.from_iterable(self._blocks())
+        self.random = functools.partial(next, draws)
+
+    def _blocks(self):
+        while True:
+            yield self.generator.random(self.block_size).tolist()
+
+
+def draw_source(seed=None, block_size=BLOCK_SIZE):
+    """Return a seeded random source, buffered through NumPy when available."""
+    if numpy is None:
+        return random.Random(seed)
+    return BlockDraws(seed, block_size)
+
+
+def spawn_seeds(seed, count):
+    """Derive count independent seeds for draw_source from a single seed."""
+    if numpy is None:
+        base = random.Random(seed)
+        return [base.getrandbits(64) for _ in range(count)]
+    return numpy.random.SeedSequence(seed).spawn(count)
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""A local generation server that keeps grammars loaded.
+
+The server speaks a small subset of HTTP/1.1 over TCP or a Unix socket:
+
+GET /generate?symbol=default&n=1&grammar=name
+  {"results": [...]}, n expansions of symbol. grammar may be left out when
+  a single grammar is served.
+GET /stats
+  throughput and latency counters, see ServerStats.as_dict()
+
+Requests for the same grammar and symbol that arrive while a batch for them
+is being generated are coalesced into the next batch, which is expanded in
+one go on a worker thread, so the event loop only parses requests and
+writes responses. Each request still gets fresh variables.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import json
+import time
+import urllib.parse
+
+from .library import GrammarLibrary
+
+
+class ServerStats(object):
+    """Throughput and latency counters of a GenerationServer.
+
+    Latency percentiles are computed over the last window requests.
+    """
+
+    def __init__(self, window=1024):
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.generations = 0
+        self.latencies = collections.deque(maxlen=window)
+
+    def record(self, latency, count):
+        """Count a served request of count expansions that took latency
+        seconds.
+        """
+        self.requests += 1
+        self.generations += count
+        self.latencies.append(latency)
+
+    def percentile(self, q):
+        """Return the q-th percentile of the recent latencies in seconds, or
+        None before the first request.
+        """
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q / 100.0 * len(ordered)))]
+
+    def as_dict(self):
+        """Return a snapshot of the counters as plain numbers.
+
+        uptime: seconds since the server started
+        requests, errors: generation requests served and rejected
+        batches: batches generated; requests / batches is the batching factor
+        generations: strings generated
+        requests_per_second, generations_per_second: averages since start
+        latency_p50, latency_p90, latency_p99: recent request latencies in
+          seconds
+        """
+        uptime = time.perf_counter() - self.started
+        return {
+            'uptime': uptime,
+            'requests': self.requests,
+            'errors': self.errors,
+            'batches': self.batches,
+            'generations': self.generations,
+            'requests_per_second': self.requests / uptime,
+            'generations_per_second': self.generations / uptime,
+            'latency_p50': self.percentile(50),
+            'latency_p90': self.percentile(90),
+            'latency_p99': self.percentile(99),
+        }
+
+
+class HTTPError(Exception):
+    """A request that cannot be served, answered with status."""
+
+    def __init__(self, status, message):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+        self.message = message
+
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+               405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+def load_grammars(paths):
+    """Load every grammar file in paths into a dict of Grammar by name, the
+    file name without its directory and extension. Files imported by several
+    grammars are read once, see nimrod.library.GrammarLibrary.
+    """
+    return GrammarLibrary().load(paths).grammars
+
+
+def generate_batch(grammar, symbol, counts):
+    """Return a list with a list of expansions of symbol for each count,
+    every one generated with fresh variables.
+    """
+    grammar.check_file()
+    context = grammar.new_context()
+    results = []
+    for count in counts:
+        context.reset()
+        results.append(context.generate(symbol, count))
+    return results
+
+
+class GenerationServer(object):
+    """Serve generations from a dict of loaded grammars by name.
+
+    Batches are generated on threads, which run Python code one at a time:
+    more workers keep slow batches from holding up others, but do not
+    generate faster than a single core. To use several cores, run a server
+    per core.
+
+    OPTIONAL ARGUMENTS:
+    workers: int (default None)
+      threads generating batches; the executor's default if None
+    max_count: int (default 10000)
+      largest n a single request may ask for
+    """
+
+    def __init__(self, grammars, workers=None, max_count=10000):
+        self.grammars = grammars
+        self.max_count = max_count
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.stats = ServerStats()
+        # (grammar, symbol) -> list of (count, future) waiting for a batch
+        self.pending = {}
+        # (grammar, symbol) whose batch is being generated
+        self.running = set()
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=8000, path=None):
+        """Start listening on host and port, or on the Unix socket at path
+        if it is given.
+        """
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self._handle, path)
+        else:
+            self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server
+
+    @property
+    def address(self):
+        """The address the server listens on."""
+        return self.server.sockets[0].getsockname()
+
+    async def close(self):
+        """Stop listening and shut the worker threads down."""
+        self.server.close()
+        await self.server.wait_closed()
+        self.executor.shutdown(wait=False)
+
+    async def generate(self, name, symbol, count):
+        """Return a list of count expansions of symbol from the grammar
+        called name, generated in a batch with concurrent requests for the
+        same symbol.
+        """
+        key = (name, symbol)
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(key, []).append((count, future))
+        if key not in self.running:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key):
+        requests = self.pending.pop(key)
+        self.running.add(key)
+        self.stats.batches += 1
+        work = asyncio.get_running_loop().run_in_executor(
+            self.executor, generate_batch, self.grammars[key[0]], key[1],
+            [count for count, future in requests])
+        work.add_done_callback(
+            lambda work: self._finish(key, requests, work))
+
+    def _finish(self, key, requests, work):
+        self.running.discard(key)
+        if key in self.pending:
+            self._flush(key)
+        error = work.exception()
+        for i, (count, future) in enumerate(requests):
+            if future.cancelled():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(work.result()[i])
+
+    async def _dispatch(self, method, target):
+        url = urllib.parse.urlsplit(target)
+        if url.path not in ('/generate', '/stats'):
+            raise HTTPError(404, 'no such path: ' + url.path)
+        if method != 'GET':
+            raise HTTPError(405, 'only GET is supported')
+        if url.path == '/stats':
+            return self.stats.as_dict()
+
+        start = time.perf_counter()
+        query = dict(urllib.parse.parse_qsl(url.query))
+        name = query.get('grammar')
+        if name is None and len(self.grammars) == 1:
+            name = next(iter(self.grammars))
+        if name not in self.grammars:
+            raise HTTPError(404, 'no such grammar: {}'.format(name))
+        try:
+            count = int(query.get('n', 1))
+        except ValueError:
+            raise HTTPError(400, 'n must be an integer')
+        if not 0 <= count <= self.max_count:
+            raise HTTPError(400, 'n must be between 0 and {}'.format(
+                self.max_count))
+        results = await self.generate(name, query.get('symbol', 'default'),
+                                      count)
+        self.stats.record(time.perf_counter() - start, count)
+        return {'results': results}
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = header.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get('content-length') or 0)
+                if length:
+                    await reader.readexactly(length)
+
+                parts = line.decode('latin-1').split()
+                status = 200
+                try:
+                    if len(parts) != 3:
+                        raise HTTPError(400, 'malformed request line')
+                    body = await self._dispatch(parts[0], parts[1])
+                except HTTPError as error:
+                    self.stats.errors += 1
+                    status, body = error.status, {'error': error.message}
+                except Exception as error:
+                    self.stats.errors += 1
+                    status, body = 500, {'error': str(error)}
+
+                keep_alive = (len(parts) == 3 and parts[2] == 'HTTP/1.1'
+                              and headers.get('connection') != 'close')
+                data = json.dumps(body).encode('utf-8')
+                writer.write((
+                    'HTTP/1.1 {} {}\r\n'
+                    'Content-Type: application/json\r\n'
+                    'Content-Length: {}\r\n'
+                    'Connection: {}\r\n\r\n').format(
+                        status, STATUS_TEXT[status], len(data),
+                        'keep-alive' if keep_alive else 'close'
+                    ).encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def serve(grammars, host='127.0.0.1', port=8000, path=None, workers=None):
+    """Serve a dict of grammars by name until interrupted."""
+    async def run():
+        server = GenerationServer(grammars, workers=workers)
+        await server.start(host, port, path)
+        try:
+            await server.server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
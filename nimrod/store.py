@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Compact, shared storage of loaded grammar files.
+
+The lines of a symbol are kept in a TextTable: one string holding all of
+their text and an array of offsets into it, instead of a list of separate
+string objects. A symbol whose lines are all plain text also uses that
+table as its compiled entries, so its entries are plain strings and cost no
+nodes at all.
+
+The compiled definitions of a file are immutable once built and are shared
+by every grammar in the process that loads the same version of the file,
+identified by its path, modification time and size.
+"""
+import array
+import threading
+
+from .cache import file_key
+
+
+class TextTable(object):
+    """An immutable sequence of strings stored in a single text buffer."""
+    __slots__ = ('text', 'offsets')
+
+    def __init__(self, strings=()):
+        strings = list(strings)
+        offsets = array.array('L', [0])
+        position = 0
+        for string in strings:
+            position += len(string)
+            offsets.append(position)
+        self.text = ''.join(strings)
+        self.offsets = offsets
+
+    def __reduce__(self):
+        return _table, (self.text, self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.offsets) - 1
+        if not 0 <= index < len(self.offsets) - 1:
+            raise IndexError('TextTable index out of range')
+        return self.text[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        text = self.text
+        offsets = self.offsets
+        for i in range(len(offsets) - 1):
+            yield text[offsets[i]:offsets[i + 1]]
+
+    def __eq__(self, other):
+        if isinstance(other, TextTable):
+            return self.text == other.text and self.offsets == other.offsets
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'TextTable({!r})'.format(list(self))
+
+
+class Source(dict):
+    """The compiled definitions of one file by symbol.
+
+    wordlists: dict of path -> modification time of every word list the
+      file reads
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Source, self).__init__(*args, **kwargs)
+        self.wordlists = {}
+
+
+def _table(text, offsets):
+    table = TextTable.__new__(TextTable)
+    table.text = text
+    table.offsets = offsets
+    return table
+
+
+def concat(parts):
+    """Return the sequences in parts joined into one. A single part is
+    returned as it is, and TextTables stay TextTables.
+    """
+    if len(parts) == 1:
+        return parts[0]
+    if all(isinstance(part, TextTable) for part in parts):
+        return TextTable(line for part in parts for line in part)
+    return tuple(item for part in parts for item in part)
+
+
+# (path, flavor) -> ((size, mtime), source, imports)
+_files = {}
+_lock = threading.Lock()
+
+
+def shared_source(path, flavor, build):
+    """Return the ((size, mtime), source, imports) of the file at path.
+
+    build(path) returns the (source, imports) of the file. It is only called
+    if no grammar of the same flavor, usually its class, has built the
+    current version of the file yet; otherwise the source built then is
+    returned. Sources must never be modified.
+    """
+    stamp = file_key(path)
+    with _lock:
+        shared = _files.get((path, flavor))
+    if shared is not None and shared[0] == stamp:
+        return shared
+    source, imports = build(path)
+    share(path, flavor, stamp, source, imports)
+    return stamp, source, imports
+
+
+def is_current(path, flavor):
+    """Return whether the version of path shared for flavor is the one on
+    disk.
+    """
+    with _lock:
+        shared = _files.get((path, flavor))
+    return shared is not None and shared[0] == file_key(path)
+
+
+def share(path, flavor, stamp, source, imports):
+    """Make source and imports the shared version stamp of path."""
+    with _lock:
+        _files[(path, flavor)] = (stamp, source, imports)
+
+
+def clear():
+    """Forget every shared source. Grammars keep the sources they use."""
+    with _lock:
+        _files.clear()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Recording the random choices of an expansion and replaying them.
+
+A Trace holds the symbol that was expanded and, in the order they were
+made, the index of every entry chosen and the outcome of every gate. Choices
+that could only go one way, of a symbol with a single entry or a gate with p
+of 0 or 1, are not recorded. Replaying a trace against the same grammar
+gives back exactly the same text, so a trace of a few bytes can be stored in
+place of the text itself.
+"""
+import array
+
+from .context import Context
+
+
+def _write_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+class Trace(object):
+    """The choices made by one expansion of symbol, in an array of
+    unsigned ints.
+    """
+    __slots__ = ('symbol', 'choices')
+
+    def __init__(self, symbol, choices=()):
+        self.symbol = symbol
+        self.choices = array.array('L', choices)
+
+    def __len__(self):
+        return len(self.choices)
+
+    def __eq__(self, other):
+        if not isinstance(other, Trace):
+            return NotImplemented
+        return self.symbol == other.symbol and self.choices == other.choices
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Trace({!r}, {!r})'.format(self.symbol, list(self.choices))
+
+    def to_bytes(self, with_symbol=True):
+        """Return the trace encoded as bytes, one byte per choice below 128.
+
+        with_symbol: bool (default True)
+          if False, leave the symbol out; it must then be passed to
+          from_bytes()
+        """
+        out = bytearray()
+        if with_symbol:
+            symbol = self.symbol.encode('utf-8')
+            _write_varint(len(symbol), out)
+            out.extend(symbol)
+        for choice in self.choices:
+            _write_varint(choice, out)
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data, symbol=None):
+        """Decode a trace encoded by to_bytes(). symbol must be given if and
+        only if it was left out of the encoding.
+        """
+        position = 0
+        if symbol is None:
+            length, position = _read_varint(data, 0)
+            symbol = bytes(data[position:position + length]).decode('utf-8')
+            position += length
+        choices = array.array('L')
+        while position < len(data):
+            choice, position = _read_varint(data, position)
+            choices.append(choice)
+        return cls(symbol, choices)
+
+
+class RecordingContext(Context):
+    """A context that records the choices it makes in self.choices."""
+
+    def __init__(self, grammar, rng=None, variables=None):
+        super(RecordingContext, self).__init__(grammar, rng, variables)
+        self.choices = array.array('L')
+
+    def choose(self, symbol, count):
+        index = Context.choose(self, symbol, count)
+        if count > 1:
+            self.choices.append(index)
+        return index
+
+    def gate(self, p):
+        taken = Context.gate(self, p)
+        if 0 < p < 1:
+            self.choices.append(taken)
+        return taken
+
+
+class ReplayContext(Context):
+    """A context that makes the choices recorded in choices instead of
+    random ones.
+    """
+
+    def __init__(self, grammar, choices):
+        super(ReplayContext, self).__init__(grammar)
+        self.choices = choices
+        self.position = 0
+
+    def next_choice(self, count):
+        if self.position >= len(self.choices):
+            raise ValueError('trace ended early: it does not match the '
+                             'grammar')
+        choice = self.choices[self.position]
+        self.position += 1
+        if choice >= count:
+            raise ValueError('trace chose {} of {} entries: it does not '
+                             'match the grammar'.format(choice, count))
+        return choice
+
+    def choose(self, symbol, count):
+        if count == 1:
+            return 0
+        return self.next_choice(count)
+
+    def gate(self, p):
+        if p >= 1:
+            return True
+        if p <= 0:
+            return False
+        return bool(self.next_choice(2))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Symbols whose entries are the lines of an external text file.
+
+A grammar file declares one with
+
+    #wordlist name path/to/names.list
+
+The file is mapped into memory rather than read, and only the offset of the
+start of each line is kept, so a list of millions of entries costs a few
+bytes per entry and picking one is a single seek.
+"""
+import array
+import mmap
+import re
+
+from .cache import file_key
+from .store import TextTable
+
+wordlist_hook = re.compile(r'#wordlist (\S+) (.+)$')
+# the start of every line that is not blank
+line_hook = re.compile(br'^[ \t]*\S', re.M)
+
+
+class WordList(TextTable):
+    """The non-blank lines of the UTF-8 text file at path, as an immutable
+    sequence of strings with trailing whitespace removed.
+
+    Replace the file rather than rewriting it in place while it is in use:
+    the mapping keeps showing the old file, while a file truncated in place
+    can crash the process that maps it.
+    """
+    __slots__ = ('path', 'stamp', 'data')
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = file_key(path)
+        self.text = None
+        with open(path, 'rb') as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files cannot be mapped
+                self.data = b''
+        typecode = 'I' if len(self.data) < 1 << 32 else 'Q'
+        self.offsets = array.array(typecode, [
+            match.start() for match in line_hook.finditer(self.data)])
+
+    def __reduce__(self):
+        return WordList, (self.path,)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        start = self.offsets[index]
+        end = self.data.find(b'\n', start)
+        if end < 0:
+            end = len(self.data)
+        return self.data[start:end].decode('utf-8').rstrip()
+
+    def __iter__(self):
+        for i in range(len(self.offsets)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if isinstance(other, WordList):
+            return self.path == other.path and self.stamp == other.stamp
+        return TextTable.__eq__(self, other)
+
+    def __repr__(self):
+        return 'WordList({!r}, {} entries)'.format(self.path, len(self))
@@ -18,6 +18,11 @@ requirements = [
     # TODO: put package requirements here
 ]
 
+extra_requirements = {
+    # block-buffered random draws for Grammar.generate_many
+    'fast': ['numpy'],
+}
+
 test_requirements = [
     # TODO: put package test requirements here
 ]
@@ -36,7 +41,15 @@ setup(
     package_dir={'nimrod':
                  'nimrod'},
     include_package_data=True,
+    # concurrent.futures, and asyncio.run() for the server
+    python_requires='>=3.7',
     install_requires=requirements,
+    extras_require=extra_requirements,
+    entry_points={
+        'console_scripts': [
+            'nimrod=nimrod.cli:main',
+        ],
+    },
     license="BSD",
     zip_safe=False,
     keywords='nimrod',
@@ -45,12 +58,13 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
         'Natural Language :: English',
-        "Programming Language :: Python :: 2",
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
     test_suite='tests',
     tests_require=test_requirements
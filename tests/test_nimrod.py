@@ -7,8 +7,43 @@ test_nimrod
 Tests for `nimrod` module.
 """
 
+import asyncio
+import collections
+import contextlib
+import http.client
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
 import nimrod
+from nimrod import cli, rng
+from nimrod.dedup import BloomFilter, digest
+from nimrod.reload import NoReload, StatReload
+from nimrod.server import GenerationServer, load_grammars
+from nimrod.store import TextTable
+from nimrod.trace import Trace
+from nimrod.wordlist import WordList
+
+
+def write_file(directory, name, text, mtime=1000):
+    path = os.path.join(directory, name + '.txt')
+    with open(path, 'w') as f:
+        f.write(text)
+    os.utime(path, (mtime, mtime))
+
+
+def fetch(address, target):
+    connection = http.client.HTTPConnection(*address[:2])
+    connection.request('GET', target)
+    response = connection.getresponse()
+    body = json.loads(response.read().decode('utf-8'))
+    connection.close()
+    return response.status, body
 
 
 class TestImports(unittest.TestCase):
@@ -31,7 +66,8 @@ class TestSyntax(unittest.TestCase):
         self.assertEqual(self.g.interpret(
             'nested-symbol', parse=False), '{symbol}')
         # test depth catching
-        # self.assertEqual(self.g.interpret('nested-symbol', depth=100), '{symbol}')
+        self.assertEqual(self.g.interpret('nested-color', depth=100),
+                         '{color}')
         # symbol doesn't exist
         self.assertEqual(self.g.interpret('not-symbol'), '{not-symbol}')
 
@@ -40,7 +76,7 @@ class TestSyntax(unittest.TestCase):
         self.assertEqual(self.g.parse('{symbol}'), 'fresh')
         self.assertEqual(self.g.parse('{nested-symbol}'), 'fresh')
         # test depth catching
-        # self.assertEqual(self.g.parse('{loop-symbol-1}'), '{loop-symbol-1}')
+        self.assertEqual(self.g.parse('{loop-symbol-1}'), '{loop-symbol-1}')
         # test symbol doesn't exist
         self.assertEqual(self.g.parse('{not-symbol}'), '{not-symbol}')
         # parse multiple symbols in one string
@@ -61,6 +97,60 @@ class TestSyntax(unittest.TestCase):
         # variables can be symbols
         self.g.parse('{set-var-2}')
         self.assertEqual(self.g.ref('var2'), '{symbol}')
+        # references see only what was set to their left
+        self.g.reset()
+        self.assertEqual(self.g.parse('$var {set-var}'), ' ')
+        self.assertEqual(self.g.parse('{set-var} $var'), ' crescent')
+
+    def test_var_depth(self):
+        # a value that refers to itself stops at max_depth, like a symbol
+        expected = ' ' + 'a' * self.g.max_depth + '$x'
+        self.assertEqual(self.g.parse('$x="a$x" $x'), expected)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        write_file(directory, 'g', '#s\n$x="a$x" $x\n')
+        g = nimrod.Grammar()
+        g.load(os.path.join(directory, 'g'))
+        self.assertTrue(''.join(g.iter_expand('s')).endswith('a$x'))
+        self.assertEqual(g.nth('s', 0), expected)
+        self.assertEqual(g.sample('s', 0, 200), expected)
+
+    def test_constant_folding(self):
+        # nested-symbol always expands to the text of symbol
+        self.assertEqual([n.text for n in self.g.compiled['nested-symbol'][0]],
+                         ['fresh'])
+        self.assertIn('nested-symbol', self.g.folded)
+        self.assertNotIn('nested-color', self.g.folded)
+        self.assertNotIn('loop-symbol-1', self.g.compiled)
+        g = nimrod.Grammar()
+        g.fold_constants = False
+        g.load('tests/def')
+        self.assertNotIn('nested-symbol', g.folded)
+        self.assertEqual(g.interpret('nested-symbol'), 'fresh')
+
+    def test_weights(self):
+        table = self.g.alias_tables['weighted']
+        for p, expected in zip(table.probabilities(), [0.9, 0.1]):
+            self.assertAlmostEqual(p, expected)
+        self.assertNotIn('color', self.g.alias_tables)
+        self.g.rng = random.Random(1)
+        picks = [self.g.interpret('weighted', parse=False)
+                 for _ in range(1000)]
+        self.assertEqual(set(picks), set(['heads', 'tails']))
+        self.assertTrue(800 < picks.count('heads') < 980)
+
+    def test_zero_weights(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        write_file(directory, 'g', '#never\n^0 nope\n^0 never\n'
+                                   '#s\nsay {never}\n')
+        g = nimrod.Grammar()
+        with self.assertLogs('nimrod.nimrod', 'WARNING'):
+            g.load(os.path.join(directory, 'g'))
+        # no entry can be chosen, so the symbol is left unexpanded
+        self.assertNotIn('never', g.compiled)
+        self.assertEqual(g.interpret('never'), '{never}')
+        self.assertEqual(g.generate_many('s', 5), ['say {never}'] * 5)
 
     def test_p(self):
         # probability 1
@@ -75,6 +165,945 @@ class TestSyntax(unittest.TestCase):
         self.assertEqual(self.g.parse('<0|A|B>'), 'B')
 
 
+class TestAnalysis(unittest.TestCase):
+    """Test the static analysis of the symbol graph."""
+
+    def setUp(self):
+        self.g = nimrod.Grammar()
+        self.g.load('tests/def')
+
+    def test_analyze(self):
+        analysis = self.g.analyze()
+        self.assertEqual(analysis.unresolved, {})
+        # def.txt has no #default to start from
+        self.assertEqual(analysis.unreachable, set())
+        self.assertEqual(analysis.cycles, [['loop-symbol-1', 'loop-symbol-2']])
+        self.assertEqual(analysis.nonterminating,
+                         set(['loop-symbol-1', 'loop-symbol-2']))
+        self.assertEqual(analysis.min_depth['nested-symbol'], 2)
+        self.assertEqual(analysis.max_depth['nested-symbol'], 2)
+        self.assertEqual(analysis.max_depth['symbol'], 1)
+        self.assertIsNone(analysis.min_depth['loop-symbol-1'])
+        self.assertIsNone(analysis.max_depth['loop-symbol-1'])
+        # variable values count as references
+        self.assertEqual(analysis.max_depth['set-var-2'], 2)
+
+        analysis = self.g.analyze(roots=['nested-color'])
+        self.assertIn('symbol', analysis.unreachable)
+        self.assertNotIn('color', analysis.unreachable)
+
+    def test_unresolved(self):
+        g = nimrod.Grammar()
+        g.load('example/example')
+        self.assertEqual(g.analyze().unresolved, {'test': ['a']})
+
+    def test_nonterminating(self):
+        self.assertEqual(self.g.interpret('loop-symbol-1'), '{loop-symbol-1}')
+        self.assertEqual(self.g.parse('{loop-symbol-2}'), '{loop-symbol-2}')
+        g = nimrod.Grammar()
+        g.refuse_nonterminating = False
+        g.load('tests/def')
+        self.assertEqual(g.parse('{loop-symbol-1}'), '{loop-symbol-1}')
+
+    def test_prune(self):
+        pruned = self.g.prune(roots=['nested-color'])
+        self.assertIn('symbol', pruned)
+        self.assertEqual(sorted(self.g.symbols), ['color', 'nested-color'])
+        self.assertEqual(self.g.parse('{symbol}'), '{symbol}')
+        self.assertEqual(self.g.prune(roots=['not-symbol']), set())
+
+
+class TestDerivations(unittest.TestCase):
+    """Test counting and enumerating derivations."""
+
+    def setUp(self):
+        self.g = nimrod.Grammar()
+        self.g.load('tests/def')
+
+    def test_count(self):
+        self.assertEqual(self.g.count('symbol'), 1)
+        self.assertEqual(self.g.count('color'), 5)
+        self.assertEqual(self.g.count('nested-color'), 5)
+        self.assertEqual(self.g.count('not-symbol'), 1)
+        # repeated entries count on their own wherever they are referenced,
+        # whether or not constants are folded
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        write_file(directory, 'g', '#default\n{dup} {z}\n'
+                                   '#dup\nsame\nsame\n#z\n1\n2\n')
+        for fold in (True, False):
+            g = nimrod.Grammar()
+            g.fold_constants = fold
+            g.load(os.path.join(directory, 'g'))
+            self.assertEqual(g.count('dup'), 2)
+            self.assertEqual(g.count('default'), 4)
+        g = nimrod.Grammar()
+        g.load('example/example')
+        # {noun} can expand into {noun}-thing
+        self.assertRaises(ValueError, g.count, 'noun')
+
+    def test_enumerate(self):
+        colors = ['red', 'green', 'blue', 'dark grey', 'light grey']
+        self.assertEqual(list(self.g.enumerate('nested-color')), colors)
+        self.assertEqual([self.g.nth('color', i) for i in range(5)], colors)
+        self.assertEqual(self.g.nth('lazy-def', 0), 'crescent fresh')
+        self.assertRaises(IndexError, self.g.nth, 'color', 5)
+
+    def test_mixed_radix(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        write_file(directory, 'g', '#s\n{a} {b}<0.5|!>\n{b}\n'
+                                   '#a\nx\ny\n#b\n1\n2\n3\n')
+        g = nimrod.Grammar()
+        g.load(os.path.join(directory, 'g'))
+        self.assertEqual(g.count('s'), 2 * 3 * 2 + 3)
+        sentences = list(g.enumerate('s'))
+        self.assertEqual(len(set(sentences)), g.count('s'))
+        self.assertEqual(sentences[:4], ['x 1!', 'x 1', 'x 2!', 'x 2'])
+        self.assertEqual(sentences[-1], '3')
+
+
+class TestGeneration(unittest.TestCase):
+    """Test the batch generation entry points."""
+
+    def setUp(self):
+        self.g = nimrod.Grammar()
+        self.g.load('tests/def')
+
+    def test_generate_many(self):
+        self.assertEqual(self.g.generate_many('symbol', 3), ['fresh'] * 3)
+        self.assertEqual(self.g.generate_many('not-symbol', 1),
+                         ['{not-symbol}'])
+        colors = self.g.generate_many('color', 50, seed=1)
+        self.assertEqual(len(colors), 50)
+        self.assertTrue(set(colors) <= set(
+            ['red', 'green', 'blue', 'dark grey', 'light grey']))
+        # the same seed gives the same batch
+        self.assertEqual(colors, self.g.generate_many('color', 50, seed=1))
+
+    def test_generate_parallel(self):
+        colors = self.g.generate_parallel('color', 40, workers=2, seed=7)
+        self.assertEqual(len(colors), 40)
+        self.assertEqual(
+            colors, self.g.generate_parallel('color', 40, workers=2, seed=7))
+        self.assertEqual(self.g.generate_parallel('symbol', 3, workers=3),
+                         ['fresh'] * 3)
+
+    def test_generate_unique(self):
+        colors = self.g.generate_unique('color', 10, seed=2)
+        self.assertEqual(sorted(colors), ['blue', 'dark grey', 'green',
+                                          'light grey', 'red'])
+        # a deduplicator carries over between calls
+        dedup = nimrod.Deduplicator.bloom(capacity=100)
+        first = self.g.generate_unique('color', 3, dedup, seed=3)
+        rest = self.g.generate_unique('color', 10, dedup, seed=4)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(set(first + rest)), len(first + rest))
+        self.assertGreater(dedup.duplicate_rate, 0)
+
+    def test_stream(self):
+        self.g.rng = random.Random(5)
+        expected = [self.g.interpret('color') for _ in range(20)]
+        self.g.rng = random.Random(5)
+        fragments = [list(self.g.iter_expand('color')) for _ in range(20)]
+        self.assertEqual([''.join(f) for f in fragments], expected)
+        self.assertTrue(any(len(f) > 1 for f in fragments))
+
+        self.g.rng = random.Random(5)
+        out = io.StringIO()
+        self.g.stream('color', out)
+        self.assertEqual(out.getvalue(), expected[0])
+        self.assertEqual(list(self.g.iter_expand('not-symbol')),
+                         ['{not-symbol}'])
+
+
+@unittest.skipUnless(rng.numpy, 'needs NumPy')
+class TestBlockDraws(unittest.TestCase):
+    """Test the NumPy random source."""
+
+    def test_draw_source(self):
+        source = rng.draw_source(3, block_size=4)
+        self.assertIsInstance(source, rng.BlockDraws)
+        # draws run on across blocks
+        draws = [source.random() for _ in range(10)]
+        self.assertEqual(len(set(draws)), 10)
+        self.assertTrue(all(0.0 <= u < 1.0 for u in draws))
+        same = rng.draw_source(3, block_size=4)
+        self.assertEqual([same.random() for _ in range(10)], draws)
+        other = rng.draw_source(3, block_size=8)
+        self.assertEqual([other.random() for _ in range(10)], draws)
+
+    def test_spawn_seeds(self):
+        seeds = rng.spawn_seeds(7, 3)
+        self.assertEqual(len(seeds), 3)
+        firsts = [rng.draw_source(seed).random() for seed in seeds]
+        self.assertEqual(len(set(firsts)), 3)
+        self.assertEqual(
+            [rng.draw_source(seed).random() for seed in rng.spawn_seeds(7, 3)],
+            firsts)
+
+
+class TestContext(unittest.TestCase):
+    """Test generation with per-call contexts."""
+
+    def setUp(self):
+        self.g = nimrod.Grammar()
+        self.g.load('tests/def')
+
+    def test_variables(self):
+        context = self.g.new_context()
+        self.g.parse('{set-var}', context=context)
+        self.assertEqual(context.ref('var'), 'crescent')
+        self.assertEqual(self.g.ref('var'), '')
+        self.assertEqual(context.parse('$var'), 'crescent')
+        self.assertEqual(self.g.parse('$var'), '')
+        self.assertEqual(self.g.interpret('nested-color', context=context,
+                                          depth=100), '{color}')
+
+    def test_seed(self):
+        first = self.g.new_context(seed=3)
+        second = self.g.new_context(seed=3)
+        self.assertEqual([first.interpret('color') for _ in range(20)],
+                         [second.interpret('color') for _ in range(20)])
+        self.assertEqual(first.generate('color', 10),
+                         second.generate('color', 10))
+
+    def test_threads(self):
+        expected = [self.g.new_context(seed=i).generate('color', 200)
+                    for i in range(8)]
+        results = [None] * 8
+        errors = []
+
+        def work(i):
+            context = self.g.new_context(seed=i)
+            results[i] = []
+            for _ in range(200):
+                context.parse('$name="n{}"'.format(i))
+                if context.parse('$name') != 'n{}'.format(i):
+                    errors.append(i)
+                results[i].append(context.interpret('color'))
+
+        # a variable assignment uses no random decisions, so each thread
+        # draws the same colors as a single context with its seed
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(results, expected)
+
+
+class TestTrace(unittest.TestCase):
+    """Test recording and replaying the choices of an expansion."""
+
+    def setUp(self):
+        self.g = nimrod.Grammar()
+        self.g.load('example/example')
+
+    def test_render(self):
+        for text, trace in self.g.record_many('sentence', 50, seed=4):
+            self.assertEqual(self.g.render(trace), text)
+            encoded = trace.to_bytes()
+            self.assertEqual(Trace.from_bytes(encoded), trace)
+            self.assertEqual(Trace.from_bytes(
+                trace.to_bytes(with_symbol=False), 'sentence'), trace)
+            self.assertLess(len(encoded), len(text) + 10)
+        # choices that can only go one way are not recorded
+        g = nimrod.Grammar()
+        g.load('tests/def')
+        self.assertEqual(g.record('who'), ('we', Trace('who')))
+        text, trace = g.record('color', seed=1)
+        self.assertEqual(g.render(trace), text)
+        self.assertEqual(g.render(Trace('color', [3, 1])), 'dark grey')
+
+    def test_mismatch(self):
+        g = nimrod.Grammar()
+        g.load('tests/def')
+        self.assertRaises(ValueError, g.render, Trace('color', [4]))
+        self.assertRaises(ValueError, g.render, Trace('color', [3]))
+        self.assertRaises(ValueError, g.render, Trace('color', [0, 1]))
+
+
+class TestStats(unittest.TestCase):
+    """Test the opt-in generation statistics."""
+
+    def setUp(self):
+        self.g = nimrod.Grammar()
+        self.g.load('tests/def')
+
+    def test_disabled(self):
+        self.assertIsNone(self.g.stats())
+        self.g.parse('{nested-symbol}')
+        self.g.disable_stats()
+        self.assertIsNone(self.g.stats())
+
+    def test_stats(self):
+        self.g.enable_stats()
+        self.g.parse('{nested-color}')
+        stats = self.g.stats()
+        self.assertEqual(stats['expansions'], {'nested-color': 1, 'color': 1})
+        self.assertEqual(stats['depths'], {0: 1, 1: 1})
+        self.assertEqual(stats['generations'], 1)
+        # enabling again starts from zero
+        self.g.enable_stats()
+        self.g.parse('<1|A|B><0|C>')
+        self.g.generate_many('symbol', 3)
+        stats = self.g.stats()
+        self.assertEqual(stats['expansions'], {'symbol': 3})
+        self.assertEqual(stats['depths'], {0: 3})
+        self.assertEqual(stats['gates_taken'], 1)
+        self.assertEqual(stats['gates_skipped'], 1)
+        self.assertEqual(stats['generations'], 4)
+        # a symbol interpreted directly counts like a reference to it
+        self.g.enable_stats()
+        self.g.interpret('nested-color')
+        stats = self.g.stats()
+        self.assertEqual(stats['expansions'], {'nested-color': 1, 'color': 1})
+        self.assertEqual(stats['depths'], {0: 1, 1: 1})
+        ''.join(self.g.iter_expand('symbol'))
+        self.assertEqual(self.g.stats()['generations'], 2)
+        self.g.disable_stats()
+        self.assertIsNone(self.g.stats())
+        self.assertEqual(self.g.parse('{nested-symbol}'), 'fresh')
+
+
+class TestDedup(unittest.TestCase):
+    """Test the duplicate filters."""
+
+    def test_exact(self):
+        dedup = nimrod.Deduplicator.exact()
+        self.assertEqual(list(dedup.unique(['a', 'b', 'a', 'c', 'b'])),
+                         ['a', 'b', 'c'])
+        self.assertEqual(dedup.duplicate_rate, 0.4)
+
+    def test_bloom(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        self.assertGreater(sum(bloom.add(digest(str(i))) for i in range(1000)),
+                           980)
+        # repeats are never let through
+        self.assertFalse(any(bloom.add(digest(str(i))) for i in range(1000)))
+        false_positives = sum(digest('new %d' % i) in bloom
+                              for i in range(10000))
+        self.assertLess(false_positives, 200)
+        self.assertEqual(bloom.memory, 1199)
+
+
+class TestStore(unittest.TestCase):
+    """Test the compact storage shared between grammars."""
+
+    def test_text_table(self):
+        table = TextTable(['red', '', 'blue'])
+        self.assertEqual(len(table), 3)
+        self.assertEqual(list(table), ['red', '', 'blue'])
+        self.assertEqual((table[0], table[-1]), ('red', 'blue'))
+        self.assertRaises(IndexError, lambda: table[3])
+        self.assertEqual(table, ['red', '', 'blue'])
+        self.assertNotEqual(table, TextTable(['red']))
+
+    def test_shared(self):
+        first = nimrod.Grammar()
+        first.load('tests/def')
+        second = nimrod.Grammar()
+        second.load('tests/def')
+        self.assertIs(second.sources['tests/def.txt'],
+                      first.sources['tests/def.txt'])
+        self.assertIs(second.compiled['color'], first.compiled['color'])
+        # plain text symbols keep their lines in a table and nothing else
+        self.assertIs(first.compiled['who'], first.symbols['who'])
+        self.assertIsInstance(first.symbols['who'], TextTable)
+        self.assertEqual(first.compiled['color'][0], 'red')
+        # pruning one grammar leaves the shared definitions alone
+        first.prune(roots=['nested-color'])
+        self.assertEqual(second.interpret('who'), 'we')
+        self.assertIn('who', second.sources['tests/def.txt'])
+
+
+class TestLazy(unittest.TestCase):
+    """Test loading imported files when their symbols are first used."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        write_file(self.dir, 'root', '#import people\n#import places\n'
+                   '#greeting\nhello {name}\n#name\nzoe\n')
+        write_file(self.dir, 'people', '#name\nalice\nbob\n')
+        write_file(self.dir, 'places', '#place\nparis\n#far\n{place}\n')
+        self.root = os.path.join(self.dir, 'root')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def load(self, **kwargs):
+        g = nimrod.Grammar(reload_policy=NoReload())
+        g.load(self.root, lazy=True, **kwargs)
+        return g
+
+    def test_lazy(self):
+        g = self.load()
+        self.assertEqual(g.compiled, {})
+        self.assertEqual(sorted(g.pending), ['far', 'greeting', 'name',
+                                             'place'])
+        self.assertEqual(g.parse('{place}'), 'paris')
+        self.assertEqual(sorted(os.path.basename(p) for p in g.unread),
+                         ['people.txt', 'root.txt'])
+        # a symbol is only expanded once every file defining it is read
+        self.assertIn(g.interpret('greeting'),
+                      ['hello zoe', 'hello alice', 'hello bob'])
+        self.assertEqual(g.unread, {})
+        self.assertEqual(g.symbols['name'], ['zoe', 'alice', 'bob'])
+        self.assertEqual(g.interpret('nothing'), '{nothing}')
+
+        eager = nimrod.Grammar()
+        eager.load(self.root)
+        lazy = self.load()
+        self.assertEqual(lazy.generate_many('greeting', 20, seed=3),
+                         eager.generate_many('greeting', 20, seed=3))
+        lazy = self.load()
+        self.assertEqual(lazy.count('far'), 1)
+        self.assertEqual(lazy.unread, {})
+
+    def test_index_cache(self):
+        cache_dir = os.path.join(self.dir, 'cache')
+        self.load(cache=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertEqual(self.load(cache=cache_dir).parse('{far}'), 'paris')
+        write_file(self.dir, 'places', '#place\nrome\n#near\nhere\n',
+                   mtime=2000)
+        g = self.load(cache=cache_dir)
+        self.assertIn('near', g.pending)
+        self.assertEqual(g.parse('{place} {near}'), 'rome here')
+
+
+class TestWordList(unittest.TestCase):
+    """Test symbols read from external word lists."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, 'names.list'), 'w') as f:
+            f.write('alice\n\n  bob {x}  \r\ncarol')
+        write_file(self.dir, 'root', '#wordlist name names.list\nignored\n'
+                   '#greeting\nhello {name}\n')
+        self.root = os.path.join(self.dir, 'root')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_word_list(self):
+        words = WordList(os.path.join(self.dir, 'names.list'))
+        self.assertEqual(list(words), ['alice', '  bob {x}', 'carol'])
+        self.assertEqual((len(words), words[-1]), (3, 'carol'))
+        self.assertRaises(IndexError, lambda: words[3])
+
+        g = nimrod.Grammar()
+        g.load(self.root)
+        self.assertIsInstance(g.compiled['name'], WordList)
+        self.assertEqual(g.symbols['name'], ['alice', '  bob {x}', 'carol'])
+        greetings = set(g.generate_many('greeting', 50, seed=1))
+        self.assertEqual(greetings, set(['hello alice', 'hello   bob {x}',
+                                         'hello carol']))
+        self.assertEqual(g.count('greeting'), 3)
+        self.assertEqual(g.nth('greeting', 2), 'hello carol')
+
+    def test_lazy(self):
+        g = nimrod.Grammar()
+        g.load(self.root, lazy=True)
+        self.assertEqual(sorted(g.pending), ['greeting', 'name'])
+        self.assertIn(g.interpret('name'), ['alice', '  bob {x}', 'carol'])
+
+    def test_reload(self):
+        g = nimrod.Grammar(reload_policy=NoReload())
+        g.load(self.root)
+        # replace the list rather than rewrite it, see WordList
+        path = os.path.join(self.dir, 'names.list')
+        with open(path + '.new', 'w') as f:
+            f.write('dave\n')
+        os.utime(path + '.new', (2000, 2000))
+        os.replace(path + '.new', path)
+        self.assertEqual(g.reload_changed(), [self.root + '.txt'])
+        self.assertEqual(g.symbols['name'], ['dave'])
+        self.assertEqual(g.parse('{greeting}'), 'hello dave')
+        self.assertEqual(g.reload_changed(), [])
+
+
+class TestReload(unittest.TestCase):
+    """Test reloading of changed grammar files."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        write_file(self.dir, 'root',
+                   '#import leaf\n#greeting\nhello {name}\n#farewell\nbye\n')
+        write_file(self.dir, 'leaf', '#name\nalice\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_load_waits_for_reload(self):
+        g = nimrod.Grammar(reload_policy=NoReload())
+        # a reload under way holds the lock
+        g.reload_lock.acquire()
+        thread = threading.Thread(target=g.load,
+                                  args=(os.path.join(self.dir, 'root'),))
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(g.symbols, {})
+        g.reload_lock.release()
+        thread.join()
+        self.assertEqual(g.parse('{greeting}'), 'hello alice')
+
+    def test_reload_imported_file(self):
+        g = nimrod.Grammar(reload_policy=StatReload(interval=0))
+        g.load(os.path.join(self.dir, 'root'))
+        self.assertEqual(g.parse('{greeting}'), 'hello alice')
+        farewell = g.compiled['farewell']
+        write_file(self.dir, 'leaf', '#name\nbob\n', mtime=2000)
+        self.assertEqual(g.parse('{greeting}'), 'hello bob')
+        # symbols from files that did not change are not rebuilt
+        self.assertIs(g.compiled['farewell'], farewell)
+
+    def test_reload_weights(self):
+        write_file(self.dir, 'leaf', '#name\n^3 alice\nbob\n#other\n^2 x\ny\n')
+        g = nimrod.Grammar(reload_policy=StatReload(interval=0))
+        g.load(os.path.join(self.dir, 'root'))
+        other = g.alias_tables['other']
+        write_file(self.dir, 'leaf', '#name\nalice\n#other\n^2 x\ny\n',
+                   mtime=2000)
+        g.reload_changed()
+        self.assertNotIn('name', g.alias_tables)
+        self.assertEqual(g.symbols['other'], ['x', 'y'])
+        # unchanged symbols keep their alias tables
+        self.assertIs(g.alias_tables['other'], other)
+
+    def test_reload_clears_templates(self):
+        g = nimrod.Grammar(reload_policy=StatReload(interval=0))
+        g.load(os.path.join(self.dir, 'root'))
+        self.assertEqual(g.parse('{name}!'), 'alice!')
+        write_file(self.dir, 'leaf', '#name\nbob\n', mtime=2000)
+        # the folded text of the old {name} is not reused
+        self.assertEqual(g.parse('{name}!'), 'bob!')
+        self.assertEqual(g.template_cache_info()['misses'], 1)
+
+    def test_reload_removes_symbols(self):
+        g = nimrod.Grammar(reload_policy=StatReload(interval=0))
+        g.load(os.path.join(self.dir, 'root'))
+        write_file(self.dir, 'leaf', '#surname\nsmith\n', mtime=2000)
+        self.assertEqual(g.parse('{name} {surname}'), '{name} smith')
+
+    def test_no_reload(self):
+        g = nimrod.Grammar(reload_policy=NoReload())
+        g.load(os.path.join(self.dir, 'root'))
+        write_file(self.dir, 'leaf', '#name\nbob\n', mtime=2000)
+        self.assertEqual(g.parse('{name}'), 'alice')
+        self.assertEqual(g.reload_changed(),
+                         [os.path.join(self.dir, 'leaf.txt')])
+        self.assertEqual(g.parse('{name}'), 'bob')
+
+
+class TestCache(unittest.TestCase):
+    """Test the on-disk cache of compiled grammars."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.dir, 'root')
+        write_file(self.dir, 'root', '#import leaf\n#greeting\nhello {name}\n')
+        write_file(self.dir, 'leaf', '#name\nalice\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def load(self, **kwargs):
+        g = nimrod.Grammar(reload_policy=NoReload())
+        g.load(self.root, **kwargs)
+        return g
+
+    def test_cache_hit(self):
+        self.load(cache=True)
+        self.assertTrue(os.path.exists(self.root + '.nimrodc'))
+        g = nimrod.Grammar(reload_policy=NoReload())
+        g._read_file = None
+        g.load(self.root, cache=True)
+        self.assertEqual(g.parse('{greeting}'), 'hello alice')
+        self.assertEqual(g.loaded_files, set([
+            self.root + '.txt', os.path.join(self.dir, 'leaf.txt')]))
+
+    def test_stale_cache(self):
+        self.load(cache=True)
+        write_file(self.dir, 'leaf', '#name\nbob\n', mtime=2000)
+        self.assertEqual(self.load(cache=True).parse('{greeting}'),
+                         'hello bob')
+        # the rebuilt cache is used by the next load
+        g = nimrod.Grammar(reload_policy=NoReload())
+        g._read_file = None
+        g.load(self.root, cache=True)
+        self.assertEqual(g.parse('{greeting}'), 'hello bob')
+
+    def test_cache_dir(self):
+        cache_dir = os.path.join(self.dir, 'cache')
+        self.load(cache=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertEqual(self.load(cache=cache_dir).parse('{name}'), 'alice')
+
+    def test_append(self):
+        write_file(self.dir, 'other', '#import leaf\n#farewell\nbye {name}\n')
+        other = os.path.join(self.dir, 'other')
+        g = self.load(cache=True)
+        g.load(other, append=True, cache=True)
+        # the second cache holds leaf too, though the first load read it
+        g = nimrod.Grammar(reload_policy=NoReload())
+        g._read_file = None
+        g.load(other, cache=True)
+        self.assertEqual(g.parse('{farewell}'), 'bye alice')
+
+
+class TestServer(unittest.TestCase):
+    """Test the local generation server."""
+
+    def setUp(self):
+        self.grammars = load_grammars(['tests/def'])
+
+    def run_server(self, scenario, workers=None, **start):
+        async def run():
+            server = GenerationServer(self.grammars, workers=workers)
+            await server.start(**start)
+            try:
+                return await scenario(server)
+            finally:
+                await server.close()
+        return asyncio.run(run())
+
+    def test_generate(self):
+        async def scenario(server):
+            loop = asyncio.get_running_loop()
+            requests = ['/generate?symbol=color&n=3'] * 20 + [
+                '/generate?grammar=def&symbol=symbol',
+                '/generate?grammar=nope', '/generate?n=x', '/nowhere']
+            responses = await asyncio.gather(*[
+                loop.run_in_executor(None, fetch, server.address, target)
+                for target in requests])
+            stats = await loop.run_in_executor(None, fetch, server.address,
+                                               '/stats')
+            return responses, stats
+
+        responses, (status, stats) = self.run_server(scenario, port=0)
+        colors = set(['red', 'green', 'blue', 'dark grey', 'light grey'])
+        for status, body in responses[:20]:
+            self.assertEqual(status, 200)
+            self.assertEqual(len(body['results']), 3)
+            self.assertTrue(set(body['results']) <= colors)
+        self.assertEqual(responses[20], (200, {'results': ['fresh']}))
+        self.assertEqual([r[0] for r in responses[21:]], [404, 400, 404])
+        self.assertEqual(stats['requests'], 21)
+        self.assertEqual(stats['errors'], 3)
+        self.assertEqual(stats['generations'], 61)
+        # requests for different symbols are never batched together
+        self.assertGreaterEqual(stats['batches'], 2)
+
+    def test_batching(self):
+        async def scenario(server):
+            # keep the only worker busy until every request is waiting
+            release = threading.Event()
+            server.executor.submit(release.wait)
+            requests = [asyncio.ensure_future(
+                server.generate('def', 'symbol', 2)) for _ in range(10)]
+            await asyncio.sleep(0)
+            release.set()
+            return await asyncio.gather(*requests), server.stats.batches
+
+        results, batches = self.run_server(scenario, workers=1, port=0)
+        self.assertEqual(results, [['fresh', 'fresh']] * 10)
+        # the first request starts a batch, the other nine join the next
+        self.assertEqual(batches, 2)
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix sockets')
+    def test_unix_socket(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'nimrod.sock')
+
+        async def scenario(server):
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write(b'GET /generate?symbol=symbol&n=2 HTTP/1.0\r\n\r\n')
+            response = await reader.read()
+            writer.close()
+            return response
+
+        try:
+            response = self.run_server(scenario, path=path)
+        finally:
+            shutil.rmtree(directory)
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK'))
+        self.assertTrue(response.endswith(b'{"results": ["fresh", "fresh"]}'))
+
+
+class TestCommandLine(unittest.TestCase):
+    """Test the nimrod command line."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output = os.path.join(self.directory, 'out.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def generate(self, *args):
+        cli.main(['generate', 'tests/def', '-q', '-o', self.output]
+                 + list(args))
+        with open(self.output) as f:
+            return f.read()
+
+    def test_profile(self):
+        report = io.StringIO()
+        with contextlib.redirect_stdout(report):
+            cli.main(['profile', 'tests/def', '-s', 'nested-color', '-n', '5',
+                      '-w', 'calls', '-o', self.output])
+        self.assertIn('color', report.getvalue())
+        with open(self.output) as f:
+            self.assertEqual(f.read(),
+                             'nested-color 5\nnested-color;color 5\n')
+
+    def test_lines(self):
+        colors = self.generate('-s', 'color', '-n', '25', '--seed', '1',
+                               '--batch-size', '7').splitlines()
+        self.assertEqual(len(colors), 25)
+        self.assertTrue(set(colors) <= set(
+            ['red', 'green', 'blue', 'dark grey', 'light grey']))
+        self.assertEqual(colors, self.generate(
+            '-s', 'color', '-n', '25', '--seed', '1').splitlines())
+        self.assertEqual(self.generate('-s', 'symbol', '-n', '2'),
+                         'fresh\nfresh\n')
+
+    def test_ndjson(self):
+        lines = self.generate('-s', 'who', '-n', '3', '-f', 'ndjson')
+        self.assertEqual([json.loads(line) for line in lines.splitlines()],
+                         ['we'] * 3)
+
+    def test_missing_grammar(self):
+        missing = os.path.join(self.directory, 'missing')
+        for argv in (['generate', missing], ['profile', missing],
+                     ['serve', 'tests/def', missing]):
+            with self.assertRaises(SystemExit) as raised:
+                cli.main(argv)
+            self.assertEqual(
+                raised.exception.code,
+                'nimrod: cannot load grammar: {}.txt: No such file or '
+                'directory'.format(missing))
+
+    def test_workers(self):
+        colors = self.generate('-s', 'color', '-n', '30', '--seed', '2',
+                               '--workers', '2', '--batch-size', '8')
+        self.assertEqual(len(colors.splitlines()), 30)
+        self.assertEqual(colors, self.generate(
+            '-s', 'color', '-n', '30', '--seed', '2', '--workers', '2',
+            '--batch-size', '8'))
+
+
+class TestBudget(unittest.TestCase):
+    """Test the limits on a single expansion."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        write_file(self.dir, 'wide',
+                   '#wide\n{leaf}{leaf}{leaf}{leaf}\n'
+                   '#deep\n<1|{wide}>\n#leaf\nab\nab\n')
+        self.g = nimrod.Grammar()
+        # keep every {leaf} an expansion of its own
+        self.g.fold_constants = False
+        self.g.load(os.path.join(self.dir, 'wide'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_truncate(self):
+        budget = nimrod.Budget(max_chars=5)
+        self.assertEqual(self.g.parse('{wide}', budget=budget), 'ababa')
+        self.assertEqual(self.g.interpret('wide', budget=budget), 'ababa')
+        self.assertEqual(
+            self.g.parse('{wide}', budget=nimrod.Budget(max_expansions=3)),
+            'abab')
+        self.assertEqual(self.g.parse('{wide}'), 'abababab')
+
+    def test_raise(self):
+        budget = nimrod.Budget(max_expansions=2, policy='raise')
+        with self.assertRaises(nimrod.BudgetExceeded) as caught:
+            self.g.parse('{wide}', budget=budget)
+        self.assertEqual(caught.exception.limit, 'expansions')
+        self.assertEqual(caught.exception.partial, 'ab')
+        budget = nimrod.Budget(max_depth=1, policy='raise')
+        self.assertEqual(self.g.parse('{leaf}', budget=budget), 'ab')
+        with self.assertRaises(nimrod.BudgetExceeded) as caught:
+            self.g.parse('{deep}', budget=budget)
+        self.assertEqual(caught.exception.limit, 'depth')
+        with self.assertRaises(ValueError):
+            nimrod.Budget(policy='ignore')
+
+    def test_fallback(self):
+        budget = nimrod.Budget(deadline=-1, policy='fallback', fallback='?')
+        self.assertEqual(self.g.parse('x {wide}', budget=budget), '?')
+        self.assertEqual(self.g.parse('x', budget=budget), 'x')
+
+    def test_grammar_budget(self):
+        self.g.budget = nimrod.Budget(max_chars=3)
+        self.assertEqual(self.g.generate_many('wide', 2), ['aba', 'aba'])
+        self.assertEqual(''.join(self.g.iter_expand('wide')), 'aba')
+        # a budget given to the call replaces the grammar's
+        self.assertEqual(
+            self.g.parse('{wide}', budget=nimrod.Budget(max_chars=1)), 'a')
+        self.assertEqual(self.g.generate_parallel('wide', 2, workers=2),
+                         ['aba', 'aba'])
+
+
+class TestProfile(unittest.TestCase):
+    """Test the per-symbol profiler."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        write_file(self.dir, 'pair', '#pair\n{leaf}-{leaf}\n#leaf\nab\n')
+        self.g = nimrod.Grammar()
+        self.g.fold_constants = False
+        self.g.load(os.path.join(self.dir, 'pair'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_profile(self):
+        self.assertIsNone(self.g.profile())
+        self.g.enable_profiling()
+        self.assertEqual(self.g.generate_many('pair', 2), ['ab-ab', 'ab-ab'])
+        self.assertEqual(self.g.interpret('pair'), 'ab-ab')
+        profile = self.g.profile()
+        self.assertEqual(profile.collapsed('calls'),
+                         'pair 3\npair;leaf 6\n')
+        self.assertEqual(profile.collapsed('chars'),
+                         'pair 3\npair;leaf 12\n')
+        self.assertEqual(profile.top(1, 'chars')[0][0], 'leaf')
+        self.assertEqual(profile.symbols()['leaf'][1:], (12, 6))
+        self.assertIn('leaf', profile.report())
+        self.g.disable_profiling()
+        self.assertIsNone(self.g.profile())
+        with self.assertRaises(ValueError):
+            profile.collapsed('bytes')
+
+
+class CountingGrammar(nimrod.Grammar):
+    """A grammar class that counts how often each file is read."""
+    reads = None
+
+    def _build_source(self, path):
+        CountingGrammar.reads[os.path.basename(path)] += 1
+        return nimrod.Grammar._build_source(self, path)
+
+
+class TestLibrary(unittest.TestCase):
+    """Test loading many grammars that share imports."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        write_file(self.dir, 'core', '#name\nalice\n#place\nparis\n')
+        write_file(self.dir, 'hello', '#import core\n#greeting\nhi {name}\n')
+        write_file(self.dir, 'trip', '#import core\n#trip\nto {place}\n'
+                                     '#name\nbob\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read_once(self):
+        CountingGrammar.reads = collections.Counter()
+        library = nimrod.GrammarLibrary(CountingGrammar).load_directory(
+            self.dir, workers=2, processes=False)
+        self.assertEqual(library.names(), ['core', 'hello', 'trip'])
+        self.assertEqual(CountingGrammar.reads,
+                         {'core.txt': 1, 'hello.txt': 1, 'trip.txt': 1})
+        self.assertEqual(library['hello'].parse('{greeting}'), 'hi alice')
+        # loading again reads nothing that did not change
+        library.load([os.path.join(self.dir, 'hello')])
+        self.assertEqual(sum(CountingGrammar.reads.values()), 3)
+
+    def test_view(self):
+        library = nimrod.GrammarLibrary().load_directory(self.dir, workers=2)
+        view = library.view(['hello', 'trip'])
+        self.assertIs(library.view(['hello', 'trip']), view)
+        self.assertEqual(view.parse('{trip}'), 'to paris')
+        self.assertIn(view.parse('{greeting}'), ['hi alice', 'hi bob'])
+        self.assertEqual(sorted(view.symbols['name']), ['alice', 'bob'])
+        # definitions are shared with the library's grammars
+        self.assertIs(view.symbols['trip'], library['trip'].symbols['trip'])
+        self.assertNotIn('trip', library['hello'].symbols)
+
+
+class TestSample(unittest.TestCase):
+    """Test sampling expansions by length."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        write_file(self.dir, 'sizes',
+                   '#pair\n{short}{long}\n#short\nx\nxx\nxxx\n'
+                   '#long\nyy\n<0.5|y>\n'
+                   '#chain\na{chain}\nb\n'
+                   '#named\n$x="alice"{greet}\n$x="bo"{greet}\n'
+                   '#greet\nhi $x\n')
+        self.g = nimrod.Grammar()
+        self.g.load(os.path.join(self.dir, 'sizes'))
+        self.context = self.g.new_context(seed=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_lengths(self):
+        lengths = self.g.lengths('pair', 10)
+        self.assertEqual(sorted(lengths), [1, 2, 3, 4, 5])
+        self.assertAlmostEqual(lengths[1], 1 / 12.)
+        self.assertAlmostEqual(lengths[3], 4 / 12.)
+        self.assertAlmostEqual(sum(lengths.values()), 1.0)
+        # expansions longer than the limit are left out
+        self.assertEqual(sorted(self.g.lengths('pair', 2)), [1, 2])
+        chain = self.g.lengths('chain', 5)
+        self.assertEqual(sorted(chain), [1, 2, 3, 4, 5])
+        self.assertAlmostEqual(chain[3], 1 / 8.)
+
+    def test_sample(self):
+        seen = set()
+        for _ in range(50):
+            text = self.g.sample('pair', 4, 4, context=self.context)
+            self.assertEqual(len(text), 4)
+            seen.add(text)
+        self.assertEqual(seen, set(['xxyy', 'xxxy']))
+        self.assertEqual(self.g.sample('chain', 4, 4), 'aaab')
+        with self.assertRaises(ValueError):
+            self.g.sample('pair', 6, 10)
+
+    def test_variables(self):
+        for _ in range(20):
+            self.assertEqual(
+                self.g.sample('named', 5, 5, context=self.context), 'hi bo')
+
+
+class TestTemplateCache(unittest.TestCase):
+    """Test the cache of templates given to parse()."""
+
+    def setUp(self):
+        self.g = nimrod.Grammar()
+        self.g.load('tests/def')
+
+    def test_hits(self):
+        self.assertEqual(self.g.parse('{symbol} {a}', a=1), 'fresh 1')
+        self.assertEqual(self.g.parse('{symbol} {a}', a=2), 'fresh 2')
+        self.assertIs(self.g.compile('{symbol} {a}'),
+                      self.g.compile('{symbol} {a}'))
+        info = self.g.template_cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['size']),
+                         (3, 1, 1))
+
+    def test_capacity(self):
+        self.g.set_template_cache_size(2)
+        for template in ['<1|A>', '<1|B>', '<1|C>', '<1|A>']:
+            self.g.parse(template)
+        info = self.g.template_cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['size'],
+                          info['capacity']), (0, 4, 2, 2))
+        self.g.set_template_cache_size(0)
+        self.assertEqual(self.g.parse('{nested-symbol}'), 'fresh')
+        self.assertEqual(self.g.template_cache_info()['size'], 0)
+
+
 if __name__ == '__main__':
     unittest.main()
 